@@ -1,83 +1,210 @@
 import streamlit as st
 import pandas as pd
-from database import get_db_path
-import sqlite3
+from database import (
+    get_admin_users, get_admin_posts, set_users_suspended, delete_posts,
+    get_moderation_queue, resolve_reports,
+    refresh_daily_stats, get_daily_stats
+)
 import plotly.express as px
 
 def show_admin_dashboard():
     st.title("Admin Dashboard")
     
-    tab1, tab2, tab3 = st.tabs(["User Management", "Content Moderation", "Analytics"])
+    tab1, tab2, tab3, tab4 = st.tabs(["User Management", "Reports",
+                                      "Content Moderation", "Analytics"])
     
     with tab1:
         show_user_management()
     
     with tab2:
+        show_moderation_queue()
+    
+    with tab3:
         show_content_moderation()
         
-    with tab3:
+    with tab4:
         show_analytics()
 
+def _listing_cursor(key, filters):
+    """Cursor for the page of a listing being shown; restarts when filters change."""
+    if st.session_state.get(f"{key}_filters") != filters:
+        st.session_state[f"{key}_filters"] = filters
+        # Cursors of the pages visited so far, so Previous can step back
+        st.session_state[f"{key}_cursors"] = [None]
+    return st.session_state[f"{key}_cursors"][-1]
+
+def _listing_pager(key, next_cursor):
+    cursors = st.session_state[f"{key}_cursors"]
+    col1, col2 = st.columns(2)
+    with col1:
+        if len(cursors) > 1 and st.button("Previous", key=f"{key}_previous"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        if next_cursor is not None and st.button("Next", key=f"{key}_next"):
+            cursors.append(next_cursor)
+            st.rerun()
+
+def _date_range(value):
+    # st.date_input returns a partial tuple while a range is being picked
+    return (value[0] if len(value) > 0 else None,
+            value[1] if len(value) > 1 else None)
+
 def show_user_management():
-    conn = sqlite3.connect(get_db_path())
-    users = pd.read_sql_query("SELECT * FROM users", conn)
-    
     st.subheader("User Management")
-    for _, user in users.iterrows():
-        col1, col2 = st.columns([3, 1])
+    
+    col1, col2, col3 = st.columns([2, 1, 2])
+    with col1:
+        search = st.text_input("Username or email", key="admin_user_search")
+    with col2:
+        status = st.selectbox("Status", ["all", "active", "suspended"],
+                              key="admin_user_status")
+    with col3:
+        joined = st.date_input("Joined between", value=(), key="admin_user_joined")
+    
+    filters = (search, status, *_date_range(joined))
+    cursor = _listing_cursor("admin_users", filters)
+    users, next_cursor = get_admin_users(
+        cursor, search=search, status=None if status == "all" else status,
+        joined_from=filters[2], joined_to=filters[3])
+    
+    if not users:
+        st.info("No users found")
+        return
+    
+    with st.form("admin_users_form"):
+        selected = []
+        for user in users:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.write(f"**{user['username']}** · {user['email']} · "
+                         f"joined {user['join_date']} · {user['post_count']} posts · "
+                         f"{user['follower_count']} followers"
+                         + (" · **suspended**" if user['is_suspended'] else ""))
+            with col2:
+                if st.checkbox("Select", key=f"select_user_{user['user_id']}"):
+                    selected.append(user['user_id'])
+        
+        col1, col2 = st.columns(2)
         with col1:
-            st.write(f"Username: {user['username']}")
-            st.write(f"Email: {user['email']}")
+            suspend = st.form_submit_button("Suspend selected")
         with col2:
-            if st.button("Suspend", key=f"suspend_{user['user_id']}"):
-                # Add suspension logic
-                st.success(f"User {user['username']} suspended")
+            reinstate = st.form_submit_button("Reinstate selected")
+    
+    if (suspend or reinstate) and selected:
+        set_users_suspended(selected, suspended=suspend)
+        st.toast(f"{len(selected)} users {'suspended' if suspend else 'reinstated'}")
+        st.rerun()
+    
+    _listing_pager("admin_users", next_cursor)
 
-def show_content_moderation():
-    conn = sqlite3.connect(get_db_path())
-    posts = pd.read_sql_query("""
-        SELECT p.*, u.username
-        FROM posts p
-        JOIN users u ON p.user_id = u.user_id
-        ORDER BY p.created_date DESC
-    """, conn)
+def show_moderation_queue():
+    st.subheader("Reported Content")
     
-    st.subheader("Content Moderation")
-    for _, post in posts.iterrows():
+    cursor = _listing_cursor("moderation_queue", ())
+    items, next_cursor = get_moderation_queue(cursor)
+    if not items:
+        st.info("No pending reports")
+        return
+    
+    for item in items:
+        key = f"{item['content_type']}_{item['content_id']}"
         with st.container():
-            st.write(f"Posted by: {post['username']}")
-            if post['media_type'] == 'image':
-                st.image(post['video_path'])
-            else:
-                st.video(post['video_path'])
-            if st.button("Remove", key=f"remove_{post['post_id']}"):
-                # Add removal logic
-                st.success("Post removed")
+            col1, col2, col3 = st.columns([1, 3, 1])
+            with col1:
+                if item['thumbnail_path']:
+                    st.image(item['thumbnail_path'], width=120)
+                else:
+                    st.caption(f"{item['content_type']} #{item['content_id']}")
+            with col2:
+                if item['username']:
+                    st.write(f"Posted by: {item['username']}")
+                if item['caption']:
+                    st.caption(item['caption'])
+                st.write(f"{item['report_count']} reports from "
+                         f"{item['reporter_count']} users · {item['reach']} views · "
+                         f"last {item['last_reported']}")
+                st.caption(f"Reasons: {item['reasons']}")
+            with col3:
+                if item['content_type'] == 'post':
+                    if st.button("Remove", key=f"queue_remove_{key}"):
+                        resolve_reports(item['content_type'], item['content_id'],
+                                        remove=True)
+                        st.rerun()
+                if st.button("Dismiss", key=f"queue_dismiss_{key}"):
+                    resolve_reports(item['content_type'], item['content_id'],
+                                    status='dismissed')
+                    st.rerun()
+    
+    _listing_pager("moderation_queue", next_cursor)
 
-def show_analytics():
-    conn = sqlite3.connect(get_db_path())
+def show_content_moderation():
+    st.subheader("Content Moderation")
+    
+    col1, col2, col3 = st.columns([2, 1, 2])
+    with col1:
+        search = st.text_input("Caption or author", key="admin_post_search")
+    with col2:
+        status = st.selectbox("Status", ["all", "active", "archived"],
+                              key="admin_post_status")
+    with col3:
+        created = st.date_input("Posted between", value=(), key="admin_post_created")
     
-    # User growth
-    users = pd.read_sql_query("""
-        SELECT DATE(join_date) as date, COUNT(*) as count
-        FROM users
-        GROUP BY DATE(join_date)
-    """, conn)
+    filters = (search, status, *_date_range(created))
+    cursor = _listing_cursor("admin_posts", filters)
+    posts, next_cursor = get_admin_posts(
+        cursor, search=search, status=None if status == "all" else status,
+        created_from=filters[2], created_to=filters[3])
+    
+    if not posts:
+        st.info("No posts found")
+        return
+    
+    with st.form("admin_posts_form"):
+        selected = []
+        for post in posts:
+            col1, col2, col3 = st.columns([1, 3, 1])
+            with col1:
+                # Thumbnails only; originals can be many megabytes each
+                if post['thumbnail_path']:
+                    st.image(post['thumbnail_path'], width=120)
+                else:
+                    st.caption(f"{post['media_type']} (thumbnail pending)")
+            with col2:
+                st.write(f"Posted by: {post['username']} · {post['created_date']}"
+                         + (" · archived" if post['is_archived'] else ""))
+                if post['caption']:
+                    st.caption(post['caption'])
+            with col3:
+                if st.checkbox("Select", key=f"select_post_{post['post_id']}"):
+                    selected.append(post['post_id'])
+        
+        remove = st.form_submit_button("Remove selected")
+    
+    if remove and selected:
+        removed = delete_posts(selected)
+        st.toast(f"{removed} posts removed")
+        st.rerun()
+    
+    _listing_pager("admin_posts", next_cursor)
+
+def show_analytics():
+    # Only activity since the last refresh is read; history is in the rollups
+    refresh_daily_stats()
+    stats = pd.DataFrame(get_daily_stats())
+    if stats.empty:
+        st.info("No activity yet")
+        return
     
     st.subheader("User Growth")
-    fig = px.line(users, x='date', y='count', title='Daily User Signups')
+    fig = px.line(stats, x='date', y='signups', title='Daily User Signups')
     st.plotly_chart(fig)
     
-    # Engagement metrics
-    engagement = pd.read_sql_query("""
-        SELECT DATE(created_date) as date,
-               COUNT(*) as posts,
-               COUNT(DISTINCT user_id) as active_users
-        FROM posts
-        GROUP BY DATE(created_date)
-    """, conn)
-    
     st.subheader("Engagement Metrics")
-    fig2 = px.line(engagement, x='date', y=['posts', 'active_users'], 
+    fig2 = px.line(stats, x='date', y=['posts', 'active_users'], 
                    title='Daily Posts and Active Users')
-    st.plotly_chart(fig2) 
\ No newline at end of file
+    st.plotly_chart(fig2)
+    
+    fig3 = px.line(stats, x='date', y=['comments', 'trends', 'messages'],
+                   title='Daily Comments, Trends and Messages')
+    st.plotly_chart(fig3)
\ No newline at end of file
@@ -3,9 +3,11 @@ from datetime import datetime
 import pandas as pd
 from PIL import Image
 import os
-import bcrypt
 from streamlit_option_menu import option_menu
-from database import init_db, create_user, authenticate_user, check_username_exists
+from database import init_db, check_username_exists
+from auth import authenticate, register, AuthError
+from config import Config
+from jobs import start_workers
 
 # Import only essential functions first
 from pages import (
@@ -25,6 +27,26 @@ st.set_page_config(
     layout="wide"
 )
 
+def client_ip():
+    """The login client's address, or None when it can't be determined.
+
+    Streamlit 1.37 doesn't expose the peer address, so this reads
+    CLIENT_IP_HEADER as set by the reverse proxy, falling back to
+    ``st.context.ip_address`` on Streamlit versions that have it.
+    """
+    if Config.CLIENT_IP_HEADER:
+        forwarded = st.context.headers.get(Config.CLIENT_IP_HEADER)
+        if forwarded:
+            # Earlier entries come from the client and can be forged
+            return forwarded.split(',')[-1].strip() or None
+    return getattr(st.context, 'ip_address', None)
+
+@st.cache_resource
+def get_job_workers():
+    # Once per server process, not per rerun; set JOB_WORKERS=0 when
+    # workers run separately via `python jobs.py`
+    return start_workers(Config.JOB_WORKERS)
+
 def main():
     if not os.path.exists("uploads"):
         os.makedirs("uploads")
@@ -43,7 +65,12 @@ def show_login_page():
         password = st.text_input("Password", type="password", key="login_password")
         
         if st.button("Login"):
-            user_id = authenticate_user(username, password)
+            try:
+                # Failures are also throttled per client address
+                user_id = authenticate(username, password, ip=client_ip())
+            except AuthError as e:
+                st.error(str(e))
+                return
             if user_id:
                 st.session_state.user_id = user_id
                 st.session_state.username = username
@@ -61,7 +88,13 @@ def show_login_page():
         if st.button("Register"):
             if new_password != confirm_password:
                 st.error("Passwords don't match!")
-            elif create_user(new_username, email, new_password):
+                return
+            try:
+                registered = register(new_username, email, new_password)
+            except AuthError as e:
+                st.error(str(e))
+                return
+            if registered:
                 st.success("Registration successful! Please login.")
             else:
                 st.error("Username or email already exists!")
@@ -122,4 +155,5 @@ def show_main_app():
 
 if __name__ == "__main__":
     init_db()
+    get_job_workers()
     main() 
\ No newline at end of file
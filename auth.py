@@ -0,0 +1,132 @@
+import bcrypt
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from database import create_user, get_login, update_password_hash
+
+class AuthError(Exception):
+    """Login refused before checking the password: throttled or overloaded."""
+
+class LoginThrottle:
+    """Sliding-window failure counter per key, kept in memory.
+
+    A key with ``limit`` failures inside the last ``window`` seconds is
+    blocked until the oldest of them ages out. At most ``max_keys`` keys
+    are tracked; the least recently failed are dropped first.
+    """
+
+    def __init__(self, window=Config.LOGIN_FAILURE_WINDOW,
+                 max_keys=Config.LOGIN_THROTTLE_MAX_KEYS):
+        self.window = window
+        self.max_keys = max_keys
+        self.failures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _recent(self, key, now):
+        failures = self.failures.get(key)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self.failures[key]
+            return None
+        return failures
+
+    def retry_after(self, key, limit):
+        """Seconds until ``key`` may try again, or 0 if it is not blocked."""
+        with self.lock:
+            now = time.monotonic()
+            failures = self._recent(key, now)
+            if failures is None or len(failures) < limit:
+                return 0
+            return failures[-limit] + self.window - now
+
+    def record_failure(self, key):
+        with self.lock:
+            now = time.monotonic()
+            failures = self._recent(key, now)
+            if failures is None:
+                failures = self.failures[key] = deque()
+            failures.append(now)
+            self.failures.move_to_end(key)
+            while len(self.failures) > self.max_keys:
+                self.failures.popitem(last=False)
+
+    def reset(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+
+# bcrypt releases the GIL, so threads hash in parallel; the pool size
+# caps how many cores a login storm can take
+_executor = ThreadPoolExecutor(max_workers=Config.AUTH_WORKERS,
+                               thread_name_prefix="bcrypt")
+_slots = threading.BoundedSemaphore(Config.AUTH_WORKERS + Config.AUTH_MAX_PENDING)
+throttle = LoginThrottle()
+
+def _run(func, *args):
+    if not _slots.acquire(blocking=False):
+        raise AuthError("Too many logins in progress, please try again shortly")
+    try:
+        return _executor.submit(func, *args).result()
+    finally:
+        _slots.release()
+
+def hash_password(password, rounds=None):
+    salt = bcrypt.gensalt(rounds or Config.BCRYPT_ROUNDS)
+    return _run(bcrypt.hashpw, password.encode('utf-8'), salt)
+
+def check_password(password, password_hash):
+    return _run(bcrypt.checkpw, password.encode('utf-8'), password_hash)
+
+def hash_rounds(password_hash):
+    # $2b$12$<salt+hash>: the cost is the second field
+    return int(password_hash.split(b'$')[2])
+
+# Checked against for unknown usernames, so they take as long as wrong
+# passwords and don't reveal which accounts exist
+_dummy_hash = None
+
+def _get_dummy_hash():
+    global _dummy_hash
+    if _dummy_hash is None or hash_rounds(_dummy_hash) != Config.BCRYPT_ROUNDS:
+        _dummy_hash = hash_password("dummy password")
+    return _dummy_hash
+
+def authenticate(username, password, ip=None):
+    """Return the user_id for valid credentials, or None.
+
+    Raises AuthError without doing any bcrypt work while the username or
+    ``ip`` has too many recent failures, or when the hashing pool is full.
+    Hashes below the configured cost are upgraded on a successful login.
+    """
+    keys = [(f"user:{username.lower()}", Config.LOGIN_MAX_FAILURES)]
+    if ip:
+        keys.append((f"ip:{ip}", Config.LOGIN_MAX_FAILURES_PER_IP))
+    wait = max(throttle.retry_after(key, limit) for key, limit in keys)
+    if wait:
+        raise AuthError(f"Too many failed logins, try again in {int(wait) + 1} seconds")
+
+    login = get_login(username)
+    if login and login[1]:
+        user_id, password_hash = login
+        valid = check_password(password, password_hash)
+    else:
+        check_password(password, _get_dummy_hash())
+        valid = False
+
+    if not valid:
+        for key, _ in keys:
+            throttle.record_failure(key)
+        return None
+
+    throttle.reset(keys[0][0])
+    if hash_rounds(password_hash) != Config.BCRYPT_ROUNDS:
+        update_password_hash(user_id, hash_password(password))
+    return user_id
+
+def register(username, email, password, **profile):
+    """Create a user with a hashed password; False if the name or email is taken."""
+    return create_user(username, email, hash_password(password), **profile)
@@ -0,0 +1,76 @@
+"""Regression benchmark for database.get_profile_summary.
+
+Builds throwaway databases where one creator has N followers, follows N
+users and has N posts, for growing N, and times get_profile_summary on
+that creator with the query cache off. Exits non-zero if the slowest
+scale costs more than MAX_SLOWDOWN times the fastest, i.e. if profile
+views start scaling with follower or post counts again.
+
+    python bench_profile.py [N ...]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+from config import Config
+import database
+
+SCALES = [1_000, 10_000, 100_000]
+CALLS = 2_000
+MAX_SLOWDOWN = 2.0
+CREATOR_ID = 1
+
+def populate(n):
+    now = "2025-01-01 00:00:00"
+    with database.get_connection() as conn:
+        c = conn.cursor()
+        c.executemany("""INSERT INTO users (user_id, username, email, join_date)
+                         VALUES (?, ?, ?, ?)""",
+                      [(i, f"user{i}", f"user{i}@example.com", now)
+                       for i in range(1, 2 * n + 2)])
+        # Half the other users follow the creator, the other half are followed
+        c.executemany("""INSERT INTO followers (user_id, follower_id, created_date)
+                         VALUES (?, ?, ?)""",
+                      [(CREATOR_ID, i, now) for i in range(2, n + 2)]
+                      + [(i, CREATOR_ID, now) for i in range(n + 2, 2 * n + 2)])
+        c.executemany("""INSERT INTO posts (user_id, video_path, caption, created_date)
+                         VALUES (?, ?, ?, ?)""",
+                      [(CREATOR_ID, f"uploads/posts/{i}.jpg", "", now)
+                       for i in range(n)])
+    database.recount_counters()
+
+def time_summary(calls=CALLS):
+    """Median seconds per get_profile_summary call on the creator."""
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        summary = database.get_profile_summary(CREATOR_ID)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), summary
+
+def main(scales):
+    # Measure the query, not the cache in front of it
+    Config.QUERY_CACHE_MAX_BYTES = 0
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in scales:
+            os.environ['DB_PATH'] = os.path.join(tmp, f"bench_{n}.db")
+            database.init_db()
+            populate(n)
+            median, summary = time_summary()
+            expected = (n, n, n)
+            actual = (summary['post_count'], summary['follower_count'],
+                      summary['following_count'])
+            if actual != expected:
+                print(f"N={n}: wrong counts {actual}, expected {expected}")
+                return 1
+            results.append(median)
+            print(f"N={n:>7}: {median * 1e6:8.1f} us per profile summary")
+
+    slowdown = max(results) / min(results)
+    print(f"Slowdown across scales: {slowdown:.2f}x (limit {MAX_SLOWDOWN}x)")
+    return 0 if slowdown <= MAX_SLOWDOWN else 1
+
+if __name__ == "__main__":
+    sys.exit(main([int(arg) for arg in sys.argv[1:]] or SCALES))
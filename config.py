@@ -6,6 +6,11 @@ load_dotenv()
 class Config:
     # Database
     DB_PATH = os.getenv('DB_PATH', 'app_collected_data.db')
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+    DB_BUSY_TIMEOUT = int(os.getenv('DB_BUSY_TIMEOUT', 5000))  # milliseconds
+    DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 256 * 1024 * 1024))  # bytes
+    DB_CACHE_SIZE = int(os.getenv('DB_CACHE_SIZE', 16384))  # pages
+    QUERY_CACHE_MAX_BYTES = int(os.getenv('QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # 0 disables
     UPLOAD_PATH = os.getenv('UPLOAD_PATH', 'uploads')
     
     # Security
@@ -15,17 +20,70 @@ class Config:
     CLOUD_STORAGE_BUCKET = os.getenv('CLOUD_STORAGE_BUCKET')
     
     # Features
-    MAX_UPLOAD_SIZE = 5 * 1024 * 1024  # 5MB
+    MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', 5 * 1024 * 1024))  # 5MB
     ALLOWED_IMAGE_TYPES = ['png', 'jpg', 'jpeg', 'gif']
     ALLOWED_VIDEO_TYPES = ['mp4', 'mov', 'avi'] 
+    FEED_PAGE_SIZE = int(os.getenv('FEED_PAGE_SIZE', 10))
+    FEED_COMMENTS_PER_POST = int(os.getenv('FEED_COMMENTS_PER_POST', 5))
+    SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+    AUTOCOMPLETE_LIMIT = int(os.getenv('AUTOCOMPLETE_LIMIT', 8))
+    CHAT_PAGE_SIZE = int(os.getenv('CHAT_PAGE_SIZE', 50))
+    ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 25))
     
     # Update paths
     UPLOAD_PATHS = {
         'posts': 'uploads/posts',
         'stories': 'uploads/stories',
-        'challenges': 'uploads/challenges'
+        'challenges': 'uploads/challenges',
+        'renditions': 'uploads/renditions',
+        'media': 'uploads/media'
     } 
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+    # Unreferenced blobs an upload reused more recently than this are left
+    # for a later remove_media job, as that upload may not have committed yet
+    MEDIA_REUSE_GRACE = int(os.getenv('MEDIA_REUSE_GRACE', 600))  # seconds
+    
+    # Image renditions (max width, max height) generated at upload time
+    RENDITION_SIZES = {
+        'story': (200, 200),
+        'feed': (600, 600)
+    }
+    RENDITION_FORMAT = os.getenv('RENDITION_FORMAT', 'WEBP')  # or JPEG
+    RENDITION_QUALITY = int(os.getenv('RENDITION_QUALITY', 80))
+    VIDEO_MAX_DIMENSION = int(os.getenv('VIDEO_MAX_DIMENSION', 720))  # pixels
+    
+    # Authentication
+    BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))  # existing hashes are upgraded on login
+    AUTH_WORKERS = int(os.getenv('AUTH_WORKERS', 2))  # concurrent bcrypt operations
+    AUTH_MAX_PENDING = int(os.getenv('AUTH_MAX_PENDING', 32))  # queued beyond that are refused
+    LOGIN_MAX_FAILURES = int(os.getenv('LOGIN_MAX_FAILURES', 5))  # per username per window
+    LOGIN_MAX_FAILURES_PER_IP = int(os.getenv('LOGIN_MAX_FAILURES_PER_IP', 20))
+    LOGIN_FAILURE_WINDOW = int(os.getenv('LOGIN_FAILURE_WINDOW', 300))  # seconds
+    LOGIN_THROTTLE_MAX_KEYS = int(os.getenv('LOGIN_THROTTLE_MAX_KEYS', 100000))
+    # Header the reverse proxy in front of Streamlit appends the client
+    # address to; its last entry is used for the per-IP login throttle.
+    # Only trust it behind such a proxy, else clients can set it themselves;
+    # empty disables it
+    CLIENT_IP_HEADER = os.getenv('CLIENT_IP_HEADER', 'X-Forwarded-For')
+    
+    # Background jobs
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+    JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1.0))  # seconds
+    JOB_VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', 300))  # seconds
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+    JOB_RETRY_BASE_DELAY = int(os.getenv('JOB_RETRY_BASE_DELAY', 5))  # seconds
+    JOB_SUPERVISE_INTERVAL = float(os.getenv('JOB_SUPERVISE_INTERVAL', 5.0))  # seconds between dead worker checks
+    STORY_EXPIRY_BATCH_SIZE = int(os.getenv('STORY_EXPIRY_BATCH_SIZE', 500))
     
     # XMPP Configuration
     XMPP_SERVER = os.getenv('XMPP_SERVER', 'localhost')
-    XMPP_PORT = int(os.getenv('XMPP_PORT', 5222)) 
\ No newline at end of file
+    XMPP_PORT = int(os.getenv('XMPP_PORT', 5222))
+    XMPP_MAX_CLIENTS = int(os.getenv('XMPP_MAX_CLIENTS', 5000))
+    XMPP_IDLE_TIMEOUT = int(os.getenv('XMPP_IDLE_TIMEOUT', 900))  # seconds
+    XMPP_RECONNECT_MAX_DELAY = int(os.getenv('XMPP_RECONNECT_MAX_DELAY', 300))  # seconds
+    XMPP_CALL_TIMEOUT = 10  # seconds to wait on the loop thread
+    XMPP_INGEST_QUEUE_SIZE = int(os.getenv('XMPP_INGEST_QUEUE_SIZE', 10000))
+    XMPP_INGEST_BATCH_SIZE = int(os.getenv('XMPP_INGEST_BATCH_SIZE', 500))
+    XMPP_INGEST_FLUSH_INTERVAL = float(os.getenv('XMPP_INGEST_FLUSH_INTERVAL', 0.05))  # seconds
+    XMPP_INGEST_MAX_ATTEMPTS = int(os.getenv('XMPP_INGEST_MAX_ATTEMPTS', 10))  # per batch, with backoff
+    XMPP_INGEST_MAX_BACKOFF = float(os.getenv('XMPP_INGEST_MAX_BACKOFF', 5))  # seconds between attempts
@@ -1,444 +1,1801 @@
 import sqlite3
 from datetime import datetime, timedelta
-import bcrypt
+import json
+import math
 import os
+import queue
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 from dotenv import load_dotenv
+from config import Config
+import query_cache
 
 load_dotenv()  # Load environment variables
 
 def get_db_path():
     return os.getenv('DB_PATH', 'app_collected_data.db')
 
+class ConnectionPool:
+    """Small pool of tuned SQLite connections shared by all sessions.
+
+    Connections are checked out for the duration of a ``with`` block and
+    returned afterwards instead of being closed, so a page render reuses a
+    handful of warm connections rather than opening one per query.
+    """
+
+    def __init__(self, db_path, size=Config.DB_POOL_SIZE):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path,
+                               timeout=Config.DB_BUSY_TIMEOUT / 1000,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={Config.DB_BUSY_TIMEOUT}")
+        conn.execute(f"PRAGMA mmap_size={Config.DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size={Config.DB_CACHE_SIZE}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        # Never hand a half-finished transaction to the next caller
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    db_path = get_db_path()
+    with _pool_lock:
+        if _pool is None or _pool.db_path != db_path:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(db_path)
+        return _pool
+
+@contextmanager
+def get_connection():
+    """Check a pooled connection out for the ``with`` block.
+
+    Commits when the block finishes normally and rolls back on error.
+    """
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+_watcher = None
+
+def _read_table_versions(token):
+    """Version source for query_cache.
+
+    ``PRAGMA data_version`` on a connection of its own changes whenever
+    any other connection, in this process or another, commits. Only then
+    is table_versions re-read, so polling is one pragma per cached read.
+    """
+    global _watcher
+    db_path = get_db_path()
+    if _watcher is None or _watcher[0] != db_path:
+        _watcher = (db_path, sqlite3.connect(db_path, check_same_thread=False))
+        token = None
+    conn = _watcher[1]
+    data_version = (db_path, conn.execute("PRAGMA data_version").fetchone()[0])
+    if data_version == token:
+        return token, None
+    try:
+        return data_version, dict(conn.execute(
+            "SELECT table_name, version FROM table_versions"))
+    except sqlite3.OperationalError:
+        return None, {}  # Not migrated yet; check again next time
+
+query_cache.set_version_source(_read_table_versions)
+
 def init_db():
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
+    with get_connection() as conn:
+        c = conn.cursor()
     
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (user_id INTEGER PRIMARY KEY,
-                  username TEXT UNIQUE,
-                  email TEXT UNIQUE,
-                  password_hash BLOB,
-                  bio TEXT,
-                  profile_pic TEXT,
-                  is_private BOOLEAN DEFAULT 0,
-                  join_date TEXT,
-                  oauth_provider TEXT,
-                  oauth_id TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS users
+                     (user_id INTEGER PRIMARY KEY,
+                      username TEXT UNIQUE,
+                      email TEXT UNIQUE,
+                      password_hash BLOB,
+                      bio TEXT,
+                      profile_pic TEXT,
+                      is_private BOOLEAN DEFAULT 0,
+                      join_date TEXT,
+                      oauth_provider TEXT,
+                      oauth_id TEXT)''')
                   
-    c.execute('''CREATE TABLE IF NOT EXISTS posts
-                 (post_id INTEGER PRIMARY KEY,
-                  user_id INTEGER,
-                  video_path TEXT,
-                  caption TEXT,
-                  created_date TEXT,
-                  trend_level INTEGER DEFAULT 1,
-                  views INTEGER DEFAULT 0,
-                  media_type TEXT DEFAULT 'video',
-                  is_archived BOOLEAN DEFAULT 0,
-                  FOREIGN KEY (user_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS posts
+                     (post_id INTEGER PRIMARY KEY,
+                      user_id INTEGER,
+                      video_path TEXT,
+                      caption TEXT,
+                      created_date TEXT,
+                      trend_level INTEGER DEFAULT 1,
+                      views INTEGER DEFAULT 0,
+                      media_type TEXT DEFAULT 'video',
+                      is_archived BOOLEAN DEFAULT 0,
+                      FOREIGN KEY (user_id) REFERENCES users(user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS comments
-                 (comment_id INTEGER PRIMARY KEY,
-                  post_id INTEGER,
-                  user_id INTEGER,
-                  comment TEXT,
-                  created_date TEXT,
-                  FOREIGN KEY (post_id) REFERENCES posts(post_id),
-                  FOREIGN KEY (user_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS comments
+                     (comment_id INTEGER PRIMARY KEY,
+                      post_id INTEGER,
+                      user_id INTEGER,
+                      comment TEXT,
+                      created_date TEXT,
+                      FOREIGN KEY (post_id) REFERENCES posts(post_id),
+                      FOREIGN KEY (user_id) REFERENCES users(user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS trends
-                 (trend_id INTEGER PRIMARY KEY,
-                  post_id INTEGER,
-                  user_id INTEGER,
-                  is_uptrend BOOLEAN,
-                  created_date TEXT,
-                  FOREIGN KEY (post_id) REFERENCES posts(post_id),
-                  FOREIGN KEY (user_id) REFERENCES users(user_id),
-                  UNIQUE(post_id, user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS trends
+                     (trend_id INTEGER PRIMARY KEY,
+                      post_id INTEGER,
+                      user_id INTEGER,
+                      is_uptrend BOOLEAN,
+                      created_date TEXT,
+                      FOREIGN KEY (post_id) REFERENCES posts(post_id),
+                      FOREIGN KEY (user_id) REFERENCES users(user_id),
+                      UNIQUE(post_id, user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS followers
-                 (id INTEGER PRIMARY KEY,
-                  user_id INTEGER,
-                  follower_id INTEGER,
-                  created_date TEXT,
-                  FOREIGN KEY (user_id) REFERENCES users(user_id),
-                  FOREIGN KEY (follower_id) REFERENCES users(user_id),
-                  UNIQUE(user_id, follower_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS followers
+                     (id INTEGER PRIMARY KEY,
+                      user_id INTEGER,
+                      follower_id INTEGER,
+                      created_date TEXT,
+                      FOREIGN KEY (user_id) REFERENCES users(user_id),
+                      FOREIGN KEY (follower_id) REFERENCES users(user_id),
+                      UNIQUE(user_id, follower_id))''')
                   
-    c.execute('''CREATE TABLE IF NOT EXISTS notifications
-                 (id INTEGER PRIMARY KEY,
-                  user_id INTEGER,
-                  type TEXT,
-                  content TEXT,
-                  is_read BOOLEAN DEFAULT 0,
-                  created_date TEXT,
-                  FOREIGN KEY (user_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS notifications
+                     (id INTEGER PRIMARY KEY,
+                      user_id INTEGER,
+                      type TEXT,
+                      content TEXT,
+                      is_read BOOLEAN DEFAULT 0,
+                      created_date TEXT,
+                      FOREIGN KEY (user_id) REFERENCES users(user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (message_id INTEGER PRIMARY KEY,
-                  sender_id INTEGER,
-                  receiver_id INTEGER,
-                  content TEXT,
-                  media_path TEXT,
-                  is_read BOOLEAN DEFAULT 0,
-                  created_date TEXT,
-                  FOREIGN KEY (sender_id) REFERENCES users(user_id),
-                  FOREIGN KEY (receiver_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS messages
+                     (message_id INTEGER PRIMARY KEY,
+                      sender_id INTEGER,
+                      receiver_id INTEGER,
+                      content TEXT,
+                      media_path TEXT,
+                      is_read BOOLEAN DEFAULT 0,
+                      created_date TEXT,
+                      FOREIGN KEY (sender_id) REFERENCES users(user_id),
+                      FOREIGN KEY (receiver_id) REFERENCES users(user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS stories
-                 (story_id INTEGER PRIMARY KEY,
-                  user_id INTEGER,
-                  media_path TEXT,
-                  caption TEXT,
-                  created_date TEXT,
-                  expires_date TEXT,
-                  FOREIGN KEY (user_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS stories
+                     (story_id INTEGER PRIMARY KEY,
+                      user_id INTEGER,
+                      media_path TEXT,
+                      caption TEXT,
+                      created_date TEXT,
+                      expires_date TEXT,
+                      FOREIGN KEY (user_id) REFERENCES users(user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS story_views
-                 (view_id INTEGER PRIMARY KEY,
-                  story_id INTEGER,
-                  viewer_id INTEGER,
-                  view_date TEXT,
-                  FOREIGN KEY (story_id) REFERENCES stories(story_id),
-                  FOREIGN KEY (viewer_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS story_views
+                     (view_id INTEGER PRIMARY KEY,
+                      story_id INTEGER,
+                      viewer_id INTEGER,
+                      view_date TEXT,
+                      FOREIGN KEY (story_id) REFERENCES stories(story_id),
+                      FOREIGN KEY (viewer_id) REFERENCES users(user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS saved_posts
-                 (save_id INTEGER PRIMARY KEY,
-                  user_id INTEGER,
-                  post_id INTEGER,
-                  created_date TEXT,
-                  FOREIGN KEY (user_id) REFERENCES users(user_id),
-                  FOREIGN KEY (post_id) REFERENCES posts(post_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS saved_posts
+                     (save_id INTEGER PRIMARY KEY,
+                      user_id INTEGER,
+                      post_id INTEGER,
+                      created_date TEXT,
+                      FOREIGN KEY (user_id) REFERENCES users(user_id),
+                      FOREIGN KEY (post_id) REFERENCES posts(post_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS challenges
-                 (challenge_id INTEGER PRIMARY KEY,
-                  creator_id INTEGER,
-                  title TEXT,
-                  description TEXT,
-                  reward_points INTEGER,
-                  created_date TEXT,
-                  end_date TEXT,
-                  status TEXT,
-                  FOREIGN KEY (creator_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS challenges
+                     (challenge_id INTEGER PRIMARY KEY,
+                      creator_id INTEGER,
+                      title TEXT,
+                      description TEXT,
+                      reward_points INTEGER,
+                      created_date TEXT,
+                      end_date TEXT,
+                      status TEXT,
+                      FOREIGN KEY (creator_id) REFERENCES users(user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS challenge_submissions
-                 (submission_id INTEGER PRIMARY KEY,
-                  challenge_id INTEGER,
-                  user_id INTEGER,
-                  media_path TEXT,
-                  caption TEXT,
-                  created_date TEXT,
-                  votes INTEGER DEFAULT 0,
-                  FOREIGN KEY (challenge_id) REFERENCES challenges(challenge_id),
-                  FOREIGN KEY (user_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS challenge_submissions
+                     (submission_id INTEGER PRIMARY KEY,
+                      challenge_id INTEGER,
+                      user_id INTEGER,
+                      media_path TEXT,
+                      caption TEXT,
+                      created_date TEXT,
+                      votes INTEGER DEFAULT 0,
+                      FOREIGN KEY (challenge_id) REFERENCES challenges(challenge_id),
+                      FOREIGN KEY (user_id) REFERENCES users(user_id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS reports
-                 (report_id INTEGER PRIMARY KEY,
-                  reporter_id INTEGER,
-                  content_type TEXT,
-                  content_id INTEGER,
-                  reason TEXT,
-                  status TEXT,
-                  created_date TEXT,
-                  FOREIGN KEY (reporter_id) REFERENCES users(user_id))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS reports
+                     (report_id INTEGER PRIMARY KEY,
+                      reporter_id INTEGER,
+                      content_type TEXT,
+                      content_id INTEGER,
+                      reason TEXT,
+                      status TEXT,
+                      created_date TEXT,
+                      FOREIGN KEY (reporter_id) REFERENCES users(user_id))''')
     
+        run_migrations(conn)
+
+# Recompute the denormalized counters from their source tables
+RECOUNT_COUNTERS = [
+    """UPDATE posts SET
+           trend_count = (SELECT COUNT(*) FROM trends t WHERE t.post_id = posts.post_id),
+           comment_count = (SELECT COUNT(*) FROM comments c WHERE c.post_id = posts.post_id)""",
+    """UPDATE users SET
+           post_count = (SELECT COUNT(*) FROM posts p WHERE p.user_id = users.user_id),
+           follower_count = (SELECT COUNT(*) FROM followers f WHERE f.user_id = users.user_id),
+           following_count = (SELECT COUNT(*) FROM followers f WHERE f.follower_id = users.user_id)""",
+]
+
+# Recompute the running vote tallies and the trend_level derived from them
+RECOUNT_TRENDS = [
+    """UPDATE posts SET
+           upvote_count = (SELECT COUNT(CASE WHEN is_uptrend THEN 1 END)
+                           FROM trends t WHERE t.post_id = posts.post_id)""",
+    """UPDATE posts SET
+           trend_level = CAST((upvote_count * 10.0) / trend_count AS INTEGER)
+       WHERE trend_count > 0""",
+]
+
+# Characters of the latest message kept on each conversation row
+PREVIEW_LENGTH = 80
+
+# Add messages to a pair's conversation row, creating it if needed
+UPSERT_CONVERSATION = """INSERT INTO conversations
+                             (user_a, user_b, last_message_id, last_message_date, preview,
+                              unread_a, unread_b, message_count)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT(user_a, user_b) DO UPDATE SET
+                             last_message_id = excluded.last_message_id,
+                             last_message_date = excluded.last_message_date,
+                             preview = excluded.preview,
+                             unread_a = unread_a + excluded.unread_a,
+                             unread_b = unread_b + excluded.unread_b,
+                             message_count = message_count + excluded.message_count"""
+
+# Sources rolled up into daily_stats: (table, date column, stat column,
+# acting user column). An insert trigger on each appends to rollup_log,
+# which the refresh drains; rowids are reused after deletes, so they
+# can't serve as a high-water mark themselves
+ROLLUP_SOURCES = [
+    ('users', 'join_date', 'signups', None),
+    ('posts', 'created_date', 'posts', 'user_id'),
+    ('comments', 'created_date', 'comments', 'user_id'),
+    ('trends', 'created_date', 'trends', 'user_id'),
+    ('messages', 'created_date', 'messages', 'sender_id'),
+]
+
+def _rollup_log_rows(table, date_column, stat, user_column, row=""):
+    # (stat, date, user_id) of a source row, for rollup_log; ``row`` is
+    # "new." inside triggers
+    user = f"{row}{user_column}" if user_column else "NULL"
+    return f"'{stat}', DATE({row}{date_column}), {user}"
+
+# Schema migrations, applied in order on top of the base tables created by
+# init_db(). PRAGMA user_version records how many have been applied, so
+# existing databases are upgraded in place. Only ever append to this list.
+MIGRATIONS = [
+    # 1: indexes for the feed, chat, follower, story and challenge lookups
+    [
+        "CREATE INDEX IF NOT EXISTS idx_comments_post_date ON comments(post_id, created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_trends_post_user_date ON trends(post_id, user_id, created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_receiver ON messages(sender_id, receiver_id, created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_receiver_sender ON messages(receiver_id, sender_id, is_read)",
+        "CREATE INDEX IF NOT EXISTS idx_followers_follower ON followers(follower_id, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_posts_user ON posts(user_id, created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_posts_created ON posts(created_date, post_id)",
+        "CREATE INDEX IF NOT EXISTS idx_stories_created ON stories(created_date, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_story_views_story ON story_views(story_id, viewer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_submissions_challenge ON challenge_submissions(challenge_id, created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_challenges_end ON challenges(end_date)",
+    ],
+    # 2: engagement counters maintained by the writers below
+    [
+        "ALTER TABLE posts ADD COLUMN trend_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN follower_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN following_count INTEGER NOT NULL DEFAULT 0",
+        *RECOUNT_COUNTERS,
+    ],
+    # 3: running upvote tally so add_trend can update trend_level in O(1)
+    [
+        "ALTER TABLE posts ADD COLUMN upvote_count INTEGER NOT NULL DEFAULT 0",
+        *RECOUNT_TRENDS,
+    ],
+    # 4: full-text search over post captions/authors and usernames,
+    # kept in sync with the source tables by triggers
+    [
+        """CREATE VIRTUAL TABLE posts_fts USING fts5(
+               caption, username, prefix='2 3', tokenize='unicode61')""",
+        """CREATE VIRTUAL TABLE users_fts USING fts5(
+               username, content='users', content_rowid='user_id',
+               prefix='2 3', tokenize='unicode61')""",
+        """CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN
+               INSERT INTO posts_fts(rowid, caption, username)
+               SELECT new.post_id, new.caption, username FROM users
+               WHERE user_id = new.user_id;
+           END""",
+        """CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN
+               DELETE FROM posts_fts WHERE rowid = old.post_id;
+           END""",
+        """CREATE TRIGGER posts_fts_update AFTER UPDATE OF caption ON posts BEGIN
+               UPDATE posts_fts SET caption = new.caption WHERE rowid = new.post_id;
+           END""",
+        """CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+               INSERT INTO users_fts(rowid, username) VALUES (new.user_id, new.username);
+           END""",
+        """CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+               INSERT INTO users_fts(users_fts, rowid, username)
+               VALUES ('delete', old.user_id, old.username);
+           END""",
+        """CREATE TRIGGER users_fts_update AFTER UPDATE OF username ON users BEGIN
+               INSERT INTO users_fts(users_fts, rowid, username)
+               VALUES ('delete', old.user_id, old.username);
+               INSERT INTO users_fts(rowid, username) VALUES (new.user_id, new.username);
+               UPDATE posts_fts SET username = new.username
+               WHERE rowid IN (SELECT post_id FROM posts WHERE user_id = new.user_id);
+           END""",
+        """INSERT INTO posts_fts(rowid, caption, username)
+           SELECT p.post_id, p.caption, u.username
+           FROM posts p JOIN users u ON p.user_id = u.user_id""",
+        "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+    ],
+    # 5: case-folded username index for prefix autocomplete
+    [
+        "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username))",
+    ],
+    # 6: one summary row per pair of users who have exchanged messages
+    # (user_a < user_b), maintained by send_message/mark_messages_as_read
+    [
+        """CREATE TABLE conversations
+               (user_a INTEGER,
+                user_b INTEGER,
+                last_message_id INTEGER,
+                last_message_date TEXT,
+                preview TEXT,
+                unread_a INTEGER NOT NULL DEFAULT 0,
+                unread_b INTEGER NOT NULL DEFAULT 0,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_a, user_b),
+                FOREIGN KEY (user_a) REFERENCES users(user_id),
+                FOREIGN KEY (user_b) REFERENCES users(user_id))""",
+        "CREATE INDEX idx_conversations_a ON conversations(user_a, last_message_date)",
+        "CREATE INDEX idx_conversations_b ON conversations(user_b, last_message_date)",
+        """INSERT INTO conversations
+               (user_a, user_b, last_message_id, unread_a, unread_b, message_count)
+           SELECT MIN(sender_id, receiver_id), MAX(sender_id, receiver_id),
+                  MAX(message_id),
+                  COUNT(CASE WHEN is_read = 0 AND receiver_id < sender_id THEN 1 END),
+                  COUNT(CASE WHEN is_read = 0 AND receiver_id > sender_id THEN 1 END),
+                  COUNT(*)
+           FROM messages
+           GROUP BY MIN(sender_id, receiver_id), MAX(sender_id, receiver_id)""",
+        f"""UPDATE conversations SET
+               last_message_date = (SELECT created_date FROM messages
+                                    WHERE message_id = last_message_id),
+               preview = (SELECT substr(content, 1, {PREVIEW_LENGTH}) FROM messages
+                          WHERE message_id = last_message_id)""",
+    ],
+    # 7: (sender, receiver) index ending in the implicit rowid, so chat
+    # history windows seek straight to a message_id
+    [
+        "DROP INDEX IF EXISTS idx_messages_sender_receiver",
+        "CREATE INDEX idx_messages_pair ON messages(sender_id, receiver_id)",
+    ],
+    # 8: resized image variants generated for each uploaded file
+    [
+        """CREATE TABLE media_renditions
+               (source_path TEXT,
+                variant TEXT,
+                path TEXT,
+                width INTEGER,
+                height INTEGER,
+                PRIMARY KEY (source_path, variant))""",
+    ],
+    # 9: reference counts for stored media, shared by every table that
+    # points at a file, so deduplicated blobs are only removed when unused
+    [
+        """CREATE TABLE media_refs
+               (path TEXT PRIMARY KEY,
+                ref_count INTEGER NOT NULL DEFAULT 0)""",
+        """INSERT INTO media_refs (path, ref_count)
+           SELECT path, COUNT(*) FROM (
+               SELECT video_path as path FROM posts
+               UNION ALL SELECT media_path FROM stories
+               UNION ALL SELECT media_path FROM messages
+               UNION ALL SELECT media_path FROM challenge_submissions)
+           WHERE path IS NOT NULL
+           GROUP BY path""",
+    ],
+    # 10: video length extracted by the background video worker
+    [
+        "ALTER TABLE posts ADD COLUMN duration REAL",
+        "CREATE INDEX IF NOT EXISTS idx_posts_video_path ON posts(video_path)",
+    ],
+    # 11: durable background job queue (see jobs.py). available_at is when
+    # a queued job may run or a running job's claim expires
+    [
+        """CREATE TABLE jobs
+               (job_id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT,
+                priority INTEGER NOT NULL DEFAULT 0,
+                dedup_key TEXT,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                available_at TEXT NOT NULL,
+                last_error TEXT,
+                created_date TEXT)""",
+        """CREATE INDEX idx_jobs_ready ON jobs(priority DESC, available_at)
+           WHERE status IN ('queued', 'running')""",
+        """CREATE UNIQUE INDEX idx_jobs_dedup ON jobs(dedup_key)
+           WHERE status IN ('queued', 'running')""",
+    ],
+    # 12: stories are read and swept by expiry, not creation date. Queue a
+    # sweep for whatever has already expired
+    [
+        """UPDATE stories SET expires_date = datetime(created_date, '+24 hours')
+           WHERE expires_date IS NULL""",
+        "DROP INDEX IF EXISTS idx_stories_created",
+        "CREATE INDEX idx_stories_expires ON stories(expires_date)",
+        """INSERT INTO jobs (kind, payload, max_attempts, available_at, created_date)
+           VALUES ('expire_stories', 'null', 5, datetime('now', 'localtime'),
+                   datetime('now', 'localtime'))""",
+    ],
+    # 13: daily analytics rollups for the admin dashboard. rollup_state holds
+    # the last rowid folded in per source table; the first refresh backfills
+    [
+        """CREATE TABLE daily_stats
+               (date TEXT PRIMARY KEY,
+                signups INTEGER NOT NULL DEFAULT 0,
+                posts INTEGER NOT NULL DEFAULT 0,
+                comments INTEGER NOT NULL DEFAULT 0,
+                trends INTEGER NOT NULL DEFAULT 0,
+                messages INTEGER NOT NULL DEFAULT 0,
+                active_users INTEGER NOT NULL DEFAULT 0)""",
+        """CREATE TABLE daily_active_users
+               (date TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (date, user_id)) WITHOUT ROWID""",
+        """CREATE TABLE rollup_state
+               (source TEXT PRIMARY KEY,
+                last_rowid INTEGER NOT NULL DEFAULT 0)""",
+    ],
+    # 14: admin suspensions; suspended users cannot log in
+    [
+        "ALTER TABLE users ADD COLUMN is_suspended BOOLEAN NOT NULL DEFAULT 0",
+    ],
+    # 15: moderation queue, one row per reported item with pending reports,
+    # ranked by priority. Filled from existing reports by a queued rebuild
+    [
+        """CREATE INDEX idx_reports_item
+           ON reports(content_type, content_id, status, reporter_id)""",
+        """CREATE TABLE moderation_queue
+               (content_type TEXT NOT NULL,
+                content_id INTEGER NOT NULL,
+                report_count INTEGER NOT NULL,
+                reporter_count INTEGER NOT NULL,
+                reach INTEGER NOT NULL DEFAULT 0,
+                priority REAL NOT NULL,
+                first_reported TEXT,
+                last_reported TEXT,
+                PRIMARY KEY (content_type, content_id))""",
+        """CREATE INDEX idx_moderation_queue_priority
+           ON moderation_queue(priority, content_type, content_id)""",
+        """INSERT INTO jobs (kind, payload, max_attempts, available_at, created_date)
+           VALUES ('rebuild_moderation_queue', 'null', 5, datetime('now', 'localtime'),
+                   datetime('now', 'localtime'))""",
+    ],
+    # 16: per-table change counters, bumped by writers in the same
+    # transaction, so every process's query cache sees every write
+    [
+        """CREATE TABLE table_versions
+               (table_name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL) WITHOUT ROWID""",
+    ],
+    # 17: feed the daily rollups from an insert log instead of rowid marks,
+    # carrying over whatever the old marks had not reached yet
+    [
+        """CREATE TABLE rollup_log
+               (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                stat TEXT NOT NULL,
+                date TEXT,
+                user_id INTEGER)""",
+        *[f"""CREATE TRIGGER rollup_{source[0]} AFTER INSERT ON {source[0]} BEGIN
+                  INSERT INTO rollup_log (stat, date, user_id)
+                  VALUES ({_rollup_log_rows(*source, row="new.")});
+              END""" for source in ROLLUP_SOURCES],
+        *[f"""INSERT INTO rollup_log (stat, date, user_id)
+              SELECT {_rollup_log_rows(*source)} FROM {source[0]}
+              WHERE rowid > IFNULL((SELECT last_rowid FROM rollup_state
+                                    WHERE source = '{source[0]}'), 0)"""
+          for source in ROLLUP_SOURCES],
+        "DROP TABLE rollup_state",
+    ],
+]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(conn):
+    """Apply every migration newer than the database's user_version.
+
+    Each migration runs in its own transaction together with the version
+    bump, so a failure leaves the database at the last good version.
+    """
     conn.commit()
-    conn.close()
+    version = get_schema_version(conn)
+    applied = False
+    for number, statements in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have migrated while we waited for the lock
+            if get_schema_version(conn) >= number:
+                conn.rollback()
+                continue
+            for statement in statements:
+                c.execute(statement)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+            applied = True
+        except Exception:
+            conn.rollback()
+            raise
+
+    if applied:
+        # Refresh planner statistics so the new indexes get picked up
+        conn.execute("ANALYZE")
+
+def _invalidate(c, *tables):
+    # Cached reads of these tables, in every process, go stale once this
+    # transaction commits
+    c.executemany("""INSERT INTO table_versions (table_name, version) VALUES (?, 1)
+                     ON CONFLICT(table_name) DO UPDATE SET version = version + 1""",
+                  [(table,) for table in tables])
+
+def _retain_media(c, path):
+    if path:
+        c.execute("""INSERT INTO media_refs (path, ref_count) VALUES (?, 1)
+                     ON CONFLICT(path) DO UPDATE SET ref_count = ref_count + 1""",
+                  (path,))
+
+def _release_media(c, path):
+    """Drop one reference to ``path``.
+
+    Returns ``[path]`` if this was the last reference, for a remove_media
+    job to reclaim, else an empty list. The ref row and renditions stay
+    until that job runs, since the same bytes may be uploaded again first.
+    """
+    if not path:
+        return []
+    c.execute("UPDATE media_refs SET ref_count = ref_count - 1 WHERE path = ?", (path,))
+    c.execute("SELECT ref_count FROM media_refs WHERE path = ?", (path,))
+    row = c.fetchone()
+    if row and row[0] > 0:
+        return []
+    return [path]
+
+def reclaim_media(paths):
+    """Forget media that is still unreferenced.
+
+    Run by the remove_media job. Uploads are content-addressed, so a path
+    released earlier may have been stored and referenced again since;
+    the check and the cleanup share one transaction so such paths, and
+    their renditions, are kept. Returns ``(path, rendition paths)`` for
+    each path forgotten, whose files the caller removes.
+    """
+    files = []
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        for path in paths:
+            c.execute("SELECT ref_count FROM media_refs WHERE path = ?", (path,))
+            row = c.fetchone()
+            if row and row[0] > 0:
+                continue
+            c.execute("DELETE FROM media_refs WHERE path = ?", (path,))
+            c.execute("SELECT path FROM media_renditions WHERE source_path = ?", (path,))
+            files.append((path, [rendition for rendition, in c.fetchall()]))
+            c.execute("DELETE FROM media_renditions WHERE source_path = ?", (path,))
+        if files:
+            _invalidate(c, 'media_renditions')
+    return files
+
+@query_cache.cached('users')
+def get_profile_summary(user_id):
+    """Profile fields and post/follower/following counts for ``user_id``.
+
+    The counts come from the counter columns the writers maintain, so
+    this is a single primary-key lookup however many posts and followers
+    the user has. Returns None for unknown users.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("""SELECT user_id, username, bio, is_private,
+                            post_count, follower_count, following_count
+                     FROM users
+                     WHERE user_id = ?""",
+                  (user_id,))
+        row = c.fetchone()
+        return dict(row) if row else None
+
+def update_profile(user_id, is_private, bio):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""UPDATE users 
+                     SET is_private = ?, bio = ?
+                     WHERE user_id = ?""",
+                  (is_private, bio, user_id))
+        _invalidate(c, 'users')
 
 def update_privacy(user_id, is_private):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("UPDATE users SET is_private = ? WHERE user_id = ?", 
-             (is_private, user_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE users SET is_private = ? WHERE user_id = ?", 
+                 (is_private, user_id))
+        _invalidate(c, 'users')
 
 def create_post(user_id, media_path, caption):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
+    with get_connection() as conn:
+        c = conn.cursor()
     
-    # Determine media type from file extension
-    media_type = 'image' if media_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')) else 'video'
+        # Determine media type from file extension
+        media_type = 'image' if media_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')) else 'video'
     
-    c.execute("""INSERT INTO posts 
-                 (user_id, video_path, caption, created_date, media_type)
-                 VALUES (?, ?, ?, ?, ?)""",
-              (user_id, media_path, caption,
-               datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-               media_type))
-    conn.commit()
-    conn.close()
+        c.execute("""INSERT INTO posts 
+                     (user_id, video_path, caption, created_date, media_type)
+                     VALUES (?, ?, ?, ?, ?)""",
+                  (user_id, media_path, caption,
+                   datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                   media_type))
+        post_id = c.lastrowid
+        c.execute("UPDATE users SET post_count = post_count + 1 WHERE user_id = ?",
+                  (user_id,))
+        _invalidate(c, 'posts', 'users')
+        _retain_media(c, media_path)
+        # Notify followers in the background; big accounts fan out to many rows
+        _enqueue(c, 'notify_followers', {'post_id': post_id})
+        return post_id
+
+def notify_followers(post_id):
+    """Write a 'new_post' notification for every follower of the post's author."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO notifications (user_id, type, content, created_date)
+                     SELECT f.follower_id, 'new_post',
+                            u.username || ' shared a new post', ?
+                     FROM posts p
+                     JOIN users u ON u.user_id = p.user_id
+                     JOIN followers f ON f.user_id = p.user_id
+                     WHERE p.post_id = ?""",
+                  (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), post_id))
 
 def add_comment(post_id, user_id, comment):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""INSERT INTO comments 
-                 (post_id, user_id, comment, created_date)
-                 VALUES (?, ?, ?, ?)""",
-              (post_id, user_id, comment,
-               datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO comments 
+                     (post_id, user_id, comment, created_date)
+                     VALUES (?, ?, ?, ?)""",
+                  (post_id, user_id, comment,
+                   datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        c.execute("UPDATE posts SET comment_count = comment_count + 1 WHERE post_id = ?",
+                  (post_id,))
+        _invalidate(c, 'comments', 'posts')
 
-def create_user(username, email, password=None, bio="", oauth_provider=None, oauth_id=None):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    try:
-        if password:
-            password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        else:
-            password_hash = None
-            
-        c.execute("""INSERT INTO users 
-                    (username, email, password_hash, bio, is_private, join_date, 
-                     oauth_provider, oauth_id) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                 (username, email, password_hash, bio, False, 
-                  datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                  oauth_provider, oauth_id))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
-
-def authenticate_user(username, password):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT user_id, password_hash FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
-    
-    if result and bcrypt.checkpw(password.encode('utf-8'), result[1]):
-        return result[0]
-    return None 
+def create_user(username, email, password_hash=None, bio="", oauth_provider=None, oauth_id=None):
+    """Insert a user; hash passwords with auth.hash_password first."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("""INSERT INTO users 
+                        (username, email, password_hash, bio, is_private, join_date, 
+                         oauth_provider, oauth_id) 
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (username, email, password_hash, bio, False, 
+                      datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                      oauth_provider, oauth_id))
+            _invalidate(c, 'users')
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+def get_login(username):
+    """``(user_id, password_hash)`` for an active user, or None."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT user_id, password_hash FROM users
+                     WHERE username = ? AND is_suspended = 0""", (username,))
+        return c.fetchone()
+
+def update_password_hash(user_id, password_hash):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE users SET password_hash = ? WHERE user_id = ?",
+                  (password_hash, user_id))
+        _invalidate(c, 'users')
+
+def _delete_post(c, post_id):
+    """Delete a post and its comments.
+
+    Returns the media files to reclaim, or None if the post was already
+    gone (removed from another tab or the reports queue).
+    """
+    # Get file path before deleting
+    c.execute("SELECT video_path, user_id FROM posts WHERE post_id = ?", (post_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    file_path, user_id = row
+
+    # Delete post
+    c.execute("DELETE FROM posts WHERE post_id = ?", (post_id,))
+    c.execute("UPDATE users SET post_count = post_count - 1 WHERE user_id = ?",
+              (user_id,))
+
+    # Delete associated comments
+    c.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
+    _invalidate(c, 'posts', 'users', 'comments')
+
+    # Reports on it are settled once it is gone
+    c.execute("""UPDATE reports SET status = 'resolved'
+                 WHERE content_type = 'post' AND content_id = ? AND status = 'pending'""",
+              (post_id,))
+    c.execute("DELETE FROM moderation_queue WHERE content_type = 'post' AND content_id = ?",
+              (post_id,))
+
+    # Only unlink media nothing else references any more
+    return _release_media(c, file_path)
 
 def delete_post(post_id):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    
+    return delete_posts([post_id]) == 1
+
+def delete_posts(post_ids):
+    """Delete several posts in one transaction; returns how many existed.
+
+    Ids of posts that are already gone are skipped.
+    """
     try:
-        # Get file path before deleting
-        c.execute("SELECT video_path FROM posts WHERE post_id = ?", (post_id,))
-        file_path = c.fetchone()[0]
-        
-        # Delete post
-        c.execute("DELETE FROM posts WHERE post_id = ?", (post_id,))
-        
-        # Delete associated comments
-        c.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
-        
-        conn.commit()
-        
-        # Delete file if it exists
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        with get_connection() as conn:
+            c = conn.cursor()
+            files = []
+            deleted = 0
+            for post_id in post_ids:
+                released = _delete_post(c, post_id)
+                if released is None:
+                    continue
+                files.extend(released)
+                deleted += 1
+            # Queued in the same transaction, so the files go even if we
+            # crash after commit
+            if files:
+                _enqueue(c, 'remove_media', {'paths': files})
+            return deleted
             
     except Exception as e:
         print(f"Error deleting post: {str(e)}")
-    finally:
-        conn.close()
+        return 0
 
 def toggle_archive_post(post_id, archive=True):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("UPDATE posts SET is_archived = ? WHERE post_id = ?", 
-             (archive, post_id))
-    conn.commit()
-    conn.close() 
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE posts SET is_archived = ? WHERE post_id = ?", 
+                 (archive, post_id))
+        _invalidate(c, 'posts')
 
 def has_user_trended(post_id, user_id):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""SELECT 1 FROM trends 
-                 WHERE post_id = ? AND user_id = ?
-                 AND created_date >= datetime('now', '-24 hours')""", 
-             (post_id, user_id))
-    result = c.fetchone() is not None
-    conn.close()
-    return result
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT 1 FROM trends 
+                     WHERE post_id = ? AND user_id = ?
+                     AND created_date >= datetime('now', '-24 hours')""", 
+                 (post_id, user_id))
+        result = c.fetchone() is not None
+        return result
 
 def add_trend(post_id, user_id, is_uptrend):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    try:
-        # Add the trend vote
-        c.execute("""INSERT INTO trends 
-                     (post_id, user_id, is_uptrend, created_date)
-                     VALUES (?, ?, ?, ?)""",
-                 (post_id, user_id, is_uptrend,
-                  datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        # Get trend counts
-        c.execute("""SELECT 
-                     COUNT(CASE WHEN is_uptrend THEN 1 END) as upvotes,
-                     COUNT(*) as total_votes
-                     FROM trends
-                     WHERE post_id = ?""",
-                 (post_id,))
+    with get_connection() as conn:
+        c = conn.cursor()
+        try:
+            # Add the trend vote
+            c.execute("""INSERT INTO trends 
+                         (post_id, user_id, is_uptrend, created_date)
+                         VALUES (?, ?, ?, ?)""",
+                     (post_id, user_id, is_uptrend,
+                      datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
         
-        upvotes, total_votes = c.fetchone()
-        # Calculate trend level (0-10 scale)
-        trend_level = int((upvotes * 10.0) / total_votes) if total_votes > 0 else 1
+            # Bump the running tallies and recalculate the trend level
+            # (0-10 scale) from them; the right-hand sides see the old values
+            upvote = 1 if is_uptrend else 0
+            c.execute("""UPDATE posts SET
+                         upvote_count = upvote_count + ?,
+                         trend_count = trend_count + 1,
+                         trend_level = CAST(((upvote_count + ?) * 10.0)
+                                            / (trend_count + 1) AS INTEGER)
+                         WHERE post_id = ?""",
+                     (upvote, upvote, post_id))
+            _invalidate(c, 'trends', 'posts')
         
-        # Update post trend level
-        c.execute("UPDATE posts SET trend_level = ? WHERE post_id = ?",
-                 (trend_level, post_id))
-        
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass  # User already voted
-    finally:
-        conn.close() 
+        except sqlite3.IntegrityError:
+            pass  # User already voted
+
+def check_trend_counters():
+    """Compare each post's running vote tallies with a full recount.
+
+    Returns ``(post_id, upvote_count, trend_count, actual_upvotes,
+    actual_total)`` for every post that has drifted.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT p.post_id, p.upvote_count, p.trend_count,
+                            IFNULL(t.upvotes, 0), IFNULL(t.total, 0)
+                     FROM posts p
+                     LEFT JOIN (SELECT post_id,
+                                       COUNT(CASE WHEN is_uptrend THEN 1 END) as upvotes,
+                                       COUNT(*) as total
+                                FROM trends
+                                GROUP BY post_id) t ON p.post_id = t.post_id
+                     WHERE p.upvote_count != IFNULL(t.upvotes, 0)
+                     OR p.trend_count != IFNULL(t.total, 0)""")
+        return c.fetchall()
+
+def _attach_recent_comments(c, posts, comment_limit):
+    """Fill post['comments'] with the newest comments of every post in one query."""
+    by_id = {post['post_id']: post for post in posts}
+    for post in posts:
+        post['comments'] = []
+    if not by_id:
+        return posts
+
+    placeholders = ",".join("?" * len(by_id))
+    c.execute(f"""SELECT comment_id, post_id, user_id, username, comment, created_date
+                  FROM (SELECT cm.*, u.username,
+                               ROW_NUMBER() OVER (PARTITION BY cm.post_id
+                                                  ORDER BY cm.created_date DESC,
+                                                           cm.comment_id DESC) AS rn
+                        FROM comments cm
+                        JOIN users u ON cm.user_id = u.user_id
+                        WHERE cm.post_id IN ({placeholders}))
+                  WHERE rn <= ?
+                  ORDER BY post_id, rn""",
+              (*by_id, comment_limit))
+    for row in c.fetchall():
+        by_id[row['post_id']]['comments'].append(dict(row))
+    return posts
+
+def record_renditions(source_path, renditions):
+    """Store ``(variant, path, width, height)`` renditions of an upload."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.executemany("""INSERT OR REPLACE INTO media_renditions
+                         (source_path, variant, path, width, height)
+                         VALUES (?, ?, ?, ?, ?)""",
+                      [(source_path, *rendition) for rendition in renditions])
+        _invalidate(c, 'media_renditions')
+
+def record_video_metadata(source_path, duration):
+    """Store the duration of a processed video on the posts that use it."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE posts SET duration = ? WHERE video_path = ?",
+                  (duration, source_path))
+        _invalidate(c, 'posts')
+
+def get_renditions(source_paths, variant):
+    """Map each of ``source_paths`` that has a ``variant`` rendition to its path."""
+    source_paths = list(set(source_paths))
+    if not source_paths:
+        return {}
+    with get_connection() as conn:
+        c = conn.cursor()
+        placeholders = ",".join("?" * len(source_paths))
+        c.execute(f"""SELECT source_path, path FROM media_renditions
+                      WHERE variant = ? AND source_path IN ({placeholders})""",
+                  (variant, *source_paths))
+        return dict(c.fetchall())
+
+@query_cache.cached('posts', 'users', 'comments', 'media_renditions')
+def get_feed_page(cursor=None, limit=Config.FEED_PAGE_SIZE,
+                  comment_limit=Config.FEED_COMMENTS_PER_POST):
+    """One page of the public home feed, newest first.
+
+    ``cursor`` is the ``(created_date, post_id)`` of the last post already
+    shown, or None for the first page. Returns ``(posts, next_cursor)``;
+    next_cursor is None once the feed is exhausted. Each post dict carries
+    a ``comments`` list with its most recent comments.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        where = "u.is_private = 0 AND p.is_archived = 0"
+        params = []
+        if cursor:
+            # Keyset pagination: seek past the last post shown on
+            # idx_posts_created instead of skipping every earlier row
+            where += " AND (p.created_date, p.post_id) < (?, ?)"
+            params.extend(cursor)
+        c.execute(f"""SELECT p.*, u.username, u.is_private,
+                             r.path as feed_path, poster.path as poster_path
+                      FROM posts p
+                      JOIN users u ON p.user_id = u.user_id
+                      LEFT JOIN media_renditions r
+                          ON r.source_path = p.video_path AND r.variant = 'feed'
+                      LEFT JOIN media_renditions poster
+                          ON poster.source_path = p.video_path AND poster.variant = 'poster'
+                      WHERE {where}
+                      ORDER BY p.created_date DESC, p.post_id DESC
+                      LIMIT ?""",
+                  (*params, limit + 1))
+        posts = [dict(row) for row in c.fetchall()]
+
+        next_cursor = None
+        if len(posts) > limit:
+            posts = posts[:limit]
+            next_cursor = (posts[-1]['created_date'], posts[-1]['post_id'])
+        return _attach_recent_comments(c, posts, comment_limit), next_cursor
+
+def get_admin_users(cursor=None, limit=Config.ADMIN_PAGE_SIZE, search=None,
+                    status=None, joined_from=None, joined_to=None):
+    """One page of users for the admin listing, newest first.
+
+    ``search`` matches a username prefix, or an exact email if it contains
+    '@'. ``status`` is 'active' or 'suspended'; ``joined_from`` and
+    ``joined_to`` are inclusive YYYY-MM-DD dates. ``cursor`` is the last
+    user_id shown. Returns ``(users, next_cursor)``.
+    """
+    where = ["1 = 1"]
+    params = []
+    if search and '@' in search:
+        where.append("u.email = ?")
+        params.append(search.strip())
+    elif search and _fts_query(search):
+        where.append("u.user_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)")
+        params.append(_fts_query(search))
+    if status:
+        where.append("u.is_suspended = ?")
+        params.append(status == 'suspended')
+    if joined_from:
+        where.append("u.join_date >= ?")
+        params.append(str(joined_from))
+    if joined_to:
+        where.append("u.join_date < date(?, '+1 day')")
+        params.append(str(joined_to))
+    if cursor:
+        where.append("u.user_id < ?")
+        params.append(cursor)
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute(f"""SELECT u.user_id, u.username, u.email, u.join_date,
+                             u.is_suspended, u.post_count, u.follower_count
+                      FROM users u
+                      WHERE {' AND '.join(where)}
+                      ORDER BY u.user_id DESC
+                      LIMIT ?""",
+                  (*params, limit + 1))
+        users = [dict(row) for row in c.fetchall()]
+
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = users[-1]['user_id']
+    return users, next_cursor
+
+def get_admin_posts(cursor=None, limit=Config.ADMIN_PAGE_SIZE, search=None,
+                    status=None, created_from=None, created_to=None):
+    """One page of posts for moderation, newest first, with thumbnails.
+
+    ``search`` matches caption or author words. ``status`` is 'active' or
+    'archived'; dates are inclusive YYYY-MM-DD. ``cursor`` is the
+    ``(created_date, post_id)`` of the last post shown. Returns
+    ``(posts, next_cursor)``; ``thumbnail_path`` is None until the
+    renditions exist.
+    """
+    where = ["1 = 1"]
+    params = []
+    if search and _fts_query(search):
+        where.append("p.post_id IN (SELECT rowid FROM posts_fts WHERE posts_fts MATCH ?)")
+        params.append(_fts_query(search))
+    if status:
+        where.append("p.is_archived = ?")
+        params.append(status == 'archived')
+    if created_from:
+        where.append("p.created_date >= ?")
+        params.append(str(created_from))
+    if created_to:
+        where.append("p.created_date < date(?, '+1 day')")
+        params.append(str(created_to))
+    if cursor:
+        where.append("(p.created_date, p.post_id) < (?, ?)")
+        params.extend(cursor)
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        # Images have a 'story' thumbnail, videos a 'poster'; never both
+        c.execute(f"""SELECT p.post_id, p.user_id, u.username, p.caption,
+                             p.media_type, p.created_date, p.is_archived,
+                             thumb.path as thumbnail_path
+                      FROM posts p
+                      JOIN users u ON p.user_id = u.user_id
+                      LEFT JOIN media_renditions thumb
+                          ON thumb.source_path = p.video_path
+                          AND thumb.variant IN ('story', 'poster')
+                      WHERE {' AND '.join(where)}
+                      ORDER BY p.created_date DESC, p.post_id DESC
+                      LIMIT ?""",
+                  (*params, limit + 1))
+        posts = [dict(row) for row in c.fetchall()]
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = (posts[-1]['created_date'], posts[-1]['post_id'])
+    return posts, next_cursor
+
+def set_users_suspended(user_ids, suspended=True):
+    """Suspend or reinstate several users in one transaction."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.executemany("UPDATE users SET is_suspended = ? WHERE user_id = ?",
+                      [(suspended, user_id) for user_id in user_ids])
+        _invalidate(c, 'users')
+
+def _fts_query(term):
+    """Turn free text into an FTS5 query matching every word as a prefix."""
+    words = term.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+def search_posts(term, page=0, limit=Config.SEARCH_PAGE_SIZE):
+    """Public posts whose caption or author matches ``term``, best first."""
+    query = _fts_query(term)
+    if not query:
+        return []
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("""SELECT p.*, u.username
+                     FROM posts_fts f
+                     JOIN posts p ON p.post_id = f.rowid
+                     JOIN users u ON p.user_id = u.user_id
+                     WHERE posts_fts MATCH ?
+                     AND u.is_private = 0 AND p.is_archived = 0
+                     ORDER BY bm25(posts_fts, 1.0, 2.0)
+                     LIMIT ? OFFSET ?""",
+                  (query, limit, page * limit))
+        return [dict(row) for row in c.fetchall()]
+
+def search_users(term, page=0, limit=Config.SEARCH_PAGE_SIZE):
+    """Users whose username matches ``term``, best first."""
+    query = _fts_query(term)
+    if not query:
+        return []
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("""SELECT u.user_id, u.username, u.profile_pic
+                     FROM users_fts f
+                     JOIN users u ON u.user_id = f.rowid
+                     WHERE users_fts MATCH ?
+                     ORDER BY bm25(users_fts)
+                     LIMIT ? OFFSET ?""",
+                  (query, limit, page * limit))
+        return [dict(row) for row in c.fetchall()]
+
+def autocomplete_usernames(prefix, user_id, limit=Config.AUTOCOMPLETE_LIMIT):
+    """Usernames starting with ``prefix`` (case-insensitive) for ``user_id``.
+
+    People the user has already messaged come first, most messaged first;
+    the rest are filled in alphabetically by a range scan on
+    idx_users_username_lower, so cost does not grow with the user count.
+    """
+    low = prefix.strip().lower()
+    if not low:
+        return []
+    high = low[:-1] + chr(ord(low[-1]) + 1)
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("""SELECT u.user_id, u.username, cv.message_count
+                     FROM (SELECT user_b as other_user_id, message_count
+                           FROM conversations WHERE user_a = ?
+                           UNION ALL
+                           SELECT user_a, message_count
+                           FROM conversations WHERE user_b = ?) cv
+                     JOIN users u ON u.user_id = cv.other_user_id
+                     WHERE lower(u.username) >= ? AND lower(u.username) < ?
+                     AND u.user_id != ?
+                     ORDER BY cv.message_count DESC, lower(u.username)
+                     LIMIT ?""",
+                  (user_id, user_id, low, high, user_id, limit))
+        matches = [dict(row) for row in c.fetchall()]
+
+        if len(matches) < limit:
+            # Over-fetch so skipping people already listed still fills the page
+            c.execute("""SELECT user_id, username, 0 as message_count
+                         FROM users
+                         WHERE lower(username) >= ? AND lower(username) < ?
+                         AND user_id != ?
+                         ORDER BY lower(username)
+                         LIMIT ?""",
+                      (low, high, user_id, limit + len(matches)))
+            seen = {match['user_id'] for match in matches}
+            for row in c.fetchall():
+                if len(matches) == limit:
+                    break
+                if row['user_id'] not in seen:
+                    matches.append(dict(row))
+        return matches
 
 def check_username_exists(username):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-    exists = c.fetchone() is not None
-    conn.close()
-    return exists 
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM users WHERE username = ?", (username,))
+        exists = c.fetchone() is not None
+        return exists 
 
 def add_follower(user_id, follower_id):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    try:
-        c.execute("""INSERT INTO followers 
-                    (user_id, follower_id, created_date) 
-                    VALUES (?, ?, ?)""",
-                 (user_id, follower_id, 
-                  datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("""INSERT INTO followers 
+                        (user_id, follower_id, created_date) 
+                        VALUES (?, ?, ?)""",
+                     (user_id, follower_id, 
+                      datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            c.execute("UPDATE users SET follower_count = follower_count + 1 WHERE user_id = ?",
+                      (user_id,))
+            c.execute("UPDATE users SET following_count = following_count + 1 WHERE user_id = ?",
+                      (follower_id,))
+            _invalidate(c, 'followers', 'users')
+            return True
+        except sqlite3.IntegrityError:
+            return False
 
 def get_user_analytics(user_id):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    
-    # Get post stats
-    c.execute("""SELECT 
-                 COUNT(*) as post_count,
-                 SUM(views) as total_views,
-                 AVG(trend_level) as avg_trend
-                 FROM posts 
-                 WHERE user_id = ?""", (user_id,))
-    stats = c.fetchone()
+    # Unknown users have no profile summary; report zero counts for them
+    summary = get_profile_summary(user_id) or {'post_count': 0, 'follower_count': 0}
+    with get_connection() as conn:
+        c = conn.cursor()
     
-    # Get follower count
-    c.execute("""SELECT COUNT(*) 
-                 FROM followers 
-                 WHERE user_id = ?""", (user_id,))
-    followers = c.fetchone()[0]
+        # Get post stats
+        c.execute("""SELECT 
+                     SUM(views) as total_views,
+                     AVG(trend_level) as avg_trend
+                     FROM posts 
+                     WHERE user_id = ?""", (user_id,))
+        stats = c.fetchone()
     
-    conn.close()
-    return {
-        'post_count': stats[0],
-        'total_views': stats[1],
-        'avg_trend': stats[2],
-        'followers': followers
-    } 
+        return {
+            'post_count': summary['post_count'],
+            'total_views': stats[0],
+            'avg_trend': stats[1],
+            'followers': summary['follower_count']
+        } 
+
+def recount_counters():
+    """Rebuild every denormalized counter from the source tables.
+
+    The writers keep the counters in step; this is the repair path for
+    rows changed outside them.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        for statement in RECOUNT_COUNTERS + RECOUNT_TRENDS:
+            c.execute(statement)
+        _invalidate(c, 'posts', 'users')
+
+def _fold_rollup_log(c):
+    """Move everything in rollup_log into the daily rollups; returns the row count."""
+    c.execute("SELECT MAX(seq) FROM rollup_log")
+    high_water = c.fetchone()[0]
+    if high_water is None:
+        return 0
+
+    c.execute("""SELECT stat, date, COUNT(*) FROM rollup_log
+                 WHERE seq <= ? AND date IS NOT NULL
+                 GROUP BY stat, date""",
+              (high_water,))
+    counts = c.fetchall()
+    for _, _, stat, _ in ROLLUP_SOURCES:
+        c.executemany(f"""INSERT INTO daily_stats (date, {stat}) VALUES (?, ?)
+                          ON CONFLICT(date) DO UPDATE SET
+                              {stat} = {stat} + excluded.{stat}""",
+                      [(date, count) for row_stat, date, count in counts
+                       if row_stat == stat])
+
+    c.execute("""INSERT OR IGNORE INTO daily_active_users (date, user_id)
+                 SELECT DISTINCT date, user_id FROM rollup_log
+                 WHERE seq <= ? AND date IS NOT NULL AND user_id IS NOT NULL""",
+              (high_water,))
+    c.executemany("""UPDATE daily_stats SET active_users =
+                         (SELECT COUNT(*) FROM daily_active_users a
+                          WHERE a.date = daily_stats.date)
+                     WHERE date = ?""",
+                  [(date,) for date in {date for _, date, _ in counts}])
+    c.execute("DELETE FROM rollup_log WHERE seq <= ?", (high_water,))
+    return sum(count for _, _, count in counts)
+
+def refresh_daily_stats():
+    """Fold rows added since the last refresh into the daily rollups.
+
+    Only the rows logged by the insert triggers since then are read, so
+    the cost follows new activity rather than table size. Returns the
+    number of source rows folded in.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        return _fold_rollup_log(c)
+
+def backfill_daily_stats():
+    """Rebuild the daily rollups from the full history."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM daily_stats")
+        c.execute("DELETE FROM daily_active_users")
+        c.execute("DELETE FROM rollup_log")
+        for source in ROLLUP_SOURCES:
+            c.execute(f"""INSERT INTO rollup_log (stat, date, user_id)
+                          SELECT {_rollup_log_rows(*source)} FROM {source[0]}""")
+        return _fold_rollup_log(c)
+
+def get_daily_stats(since=None):
+    """Daily rollup rows, oldest first, optionally from ``since`` (YYYY-MM-DD)."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("""SELECT * FROM daily_stats WHERE date >= ? ORDER BY date""",
+                  (since or '',))
+        return [dict(row) for row in c.fetchall()]
 
 def send_message(sender_id, receiver_id, content, media_path=None):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
+    # Errors must reach get_connection, so the message is rolled back
+    # rather than committed without its conversation row
     try:
-        c.execute("""INSERT INTO messages 
-                     (sender_id, receiver_id, content, media_path, is_read, created_date)
-                     VALUES (?, ?, ?, ?, ?, ?)""",
-                  (sender_id, receiver_id, content, media_path, 0,
-                   datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        conn.commit()
-        return True
+        with get_connection() as conn:
+            c = conn.cursor()
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            c.execute("""INSERT INTO messages 
+                         (sender_id, receiver_id, content, media_path, is_read, created_date)
+                         VALUES (?, ?, ?, ?, ?, ?)""",
+                      (sender_id, receiver_id, content, media_path, 0, now))
+            message_id = c.lastrowid
+            _retain_media(c, media_path)
+            
+            # Update the pair's summary row; the receiver gains an unread
+            user_a, user_b = sorted((sender_id, receiver_id))
+            unread_a, unread_b = (1, 0) if receiver_id == user_a else (0, 1)
+            c.execute(UPSERT_CONVERSATION,
+                      (user_a, user_b, message_id, now,
+                       (content or "")[:PREVIEW_LENGTH], unread_a, unread_b, 1))
+            _invalidate(c, 'messages', 'conversations')
+            return True
     except Exception as e:
         print(f"Error sending message: {str(e)}")
         return False
-    finally:
-        conn.close()
+
+def send_messages(messages):
+    """Store a batch of ``(sender_id, receiver_id, content, media_path,
+    created_date)`` tuples in a single transaction.
+
+    Used for bulk ingest, where one commit per message would serialize
+    on fsync. Conversation rows are updated once per pair in the batch.
+    """
+    if not messages:
+        return
+    with get_connection() as conn:
+        c = conn.cursor()
+        # Take the write lock up front so the ids assigned below are known
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT IFNULL(MAX(message_id), 0) FROM messages")
+        first_id = c.fetchone()[0] + 1
+        c.executemany("""INSERT INTO messages 
+                         (message_id, sender_id, receiver_id, content, media_path,
+                          is_read, created_date)
+                         VALUES (?, ?, ?, ?, ?, 0, ?)""",
+                      [(first_id + i, *message) for i, message in enumerate(messages)])
+        for _, _, _, media_path, _ in messages:
+            _retain_media(c, media_path)
+
+        pairs = {}
+        for i, (sender_id, receiver_id, content, _, created_date) in enumerate(messages):
+            user_a, user_b = sorted((sender_id, receiver_id))
+            row = pairs.setdefault((user_a, user_b), [user_a, user_b, 0, "", "", 0, 0, 0])
+            row[2:5] = first_id + i, created_date, (content or "")[:PREVIEW_LENGTH]
+            row[5 if receiver_id == user_a else 6] += 1
+            row[7] += 1
+        c.executemany(UPSERT_CONVERSATION, list(pairs.values()))
+        _invalidate(c, 'messages', 'conversations')
+
+def get_user_ids(usernames):
+    """Map each known username in ``usernames``, case-insensitively, to its user_id.
+
+    Keys are the lowercased names, as XMPP delivers them. A name shared by
+    several users differing only in case maps to None, since the caller
+    can't tell which one is meant.
+    """
+    names = list({name.lower() for name in usernames})
+    if not names:
+        return {}
+    with get_connection() as conn:
+        c = conn.cursor()
+        placeholders = ",".join("?" * len(names))
+        # Matches on idx_users_username_lower
+        c.execute(f"""SELECT lower(username), CASE WHEN COUNT(*) = 1 THEN MIN(user_id) END
+                      FROM users WHERE lower(username) IN ({placeholders})
+                      GROUP BY lower(username)""",
+                  names)
+        return dict(c.fetchall())
+
+@query_cache.cached('conversations', 'users')
+def get_conversations(user_id):
+    """Recent chats for the messages sidebar, newest first.
+
+    Reads one summary row per conversation partner instead of grouping
+    over the user's whole message history.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("""SELECT cv.other_user_id, u.username, cv.unread_count,
+                            cv.last_message, cv.preview
+                     FROM (SELECT user_b as other_user_id, unread_a as unread_count,
+                                  last_message_date as last_message, preview,
+                                  last_message_id
+                           FROM conversations WHERE user_a = ?
+                           UNION ALL
+                           SELECT user_a, unread_b, last_message_date, preview,
+                                  last_message_id
+                           FROM conversations WHERE user_b = ?) cv
+                     JOIN users u ON u.user_id = cv.other_user_id
+                     ORDER BY cv.last_message DESC, cv.last_message_id DESC""",
+                  (user_id, user_id))
+        return [dict(row) for row in c.fetchall()]
+
+@query_cache.cached('messages', 'users')
+def get_messages(conversation, before_id=None, after_id=None,
+                 limit=Config.CHAT_PAGE_SIZE):
+    """A window of the chat between the two users in ``conversation``.
+
+    With no ids, returns the latest ``limit`` messages; ``before_id`` pages
+    back through older history and ``after_id`` fetches only messages newer
+    than the last one seen. Messages are returned oldest first.
+    """
+    user_id, other_id = conversation
+    if after_id is not None:
+        condition, bound, order = "AND m.message_id > ?", (after_id,), "ASC"
+    elif before_id is not None:
+        condition, bound, order = "AND m.message_id < ?", (before_id,), "DESC"
+    else:
+        condition, bound, order = "", (), "DESC"
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        # One seek per direction on idx_messages_pair, merged and re-limited
+        c.execute(f"""SELECT * FROM (
+                          SELECT * FROM (
+                              SELECT m.*, u.username FROM messages m
+                              JOIN users u ON m.sender_id = u.user_id
+                              WHERE m.sender_id = ? AND m.receiver_id = ? {condition}
+                              ORDER BY m.message_id {order} LIMIT ?)
+                          UNION ALL
+                          SELECT * FROM (
+                              SELECT m.*, u.username FROM messages m
+                              JOIN users u ON m.sender_id = u.user_id
+                              WHERE m.sender_id = ? AND m.receiver_id = ? {condition}
+                              ORDER BY m.message_id {order} LIMIT ?))
+                      ORDER BY message_id {order}
+                      LIMIT ?""",
+                  (user_id, other_id, *bound, limit,
+                   other_id, user_id, *bound, limit, limit))
+        messages = [dict(row) for row in c.fetchall()]
+        if order == "DESC":
+            messages.reverse()
+        return messages
 
 def create_story(user_id, media_path, caption=None):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    now = datetime.now()
-    expires = now + timedelta(hours=24)
+    with get_connection() as conn:
+        c = conn.cursor()
+        now = datetime.now()
+        expires = now + timedelta(hours=24)
     
-    c.execute("""INSERT INTO stories 
-                 (user_id, media_path, caption, created_date, expires_date)
-                 VALUES (?, ?, ?, ?, ?)""",
-              (user_id, media_path, caption,
-               now.strftime("%Y-%m-%d %H:%M:%S"),
-               expires.strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
+        c.execute("""INSERT INTO stories 
+                     (user_id, media_path, caption, created_date, expires_date)
+                     VALUES (?, ?, ?, ?, ?)""",
+                  (user_id, media_path, caption,
+                   now.strftime("%Y-%m-%d %H:%M:%S"),
+                   expires.strftime("%Y-%m-%d %H:%M:%S")))
+        _retain_media(c, media_path)
+        _invalidate(c, 'stories')
+
+        # One sweep per hour in which stories expire, run at the end of it
+        sweep_at = expires.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        _enqueue(c, 'expire_stories',
+                 delay=(sweep_at - now).total_seconds(),
+                 dedup_key=f"expire_stories:{sweep_at:%Y-%m-%d %H}")
+
+def get_live_stories():
+    """Stories that have not expired yet, newest first."""
+    # Cached per minute, so stories drop out within a minute of expiring
+    return _get_live_stories(datetime.now().strftime("%Y-%m-%d %H:%M:00"))
+
+@query_cache.cached('stories', 'users', 'media_renditions')
+def _get_live_stories(as_of):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("""SELECT s.story_id, s.user_id, s.media_path, s.caption,
+                            s.created_date, u.username, r.path AS story_path
+                     FROM stories s
+                     JOIN users u ON s.user_id = u.user_id
+                     LEFT JOIN media_renditions r
+                         ON r.source_path = s.media_path AND r.variant = 'story'
+                     WHERE s.expires_date > ?
+                     ORDER BY s.created_date DESC""",
+                  (as_of,))
+        return [dict(row) for row in c.fetchall()]
+
+def expire_stories(batch_size=Config.STORY_EXPIRY_BATCH_SIZE):
+    """Delete expired stories and their views, a batch per transaction.
+
+    Media no longer referenced is queued for removal. Returns the number
+    of stories deleted.
+    """
+    deleted = 0
+    while True:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("""SELECT story_id, media_path FROM stories
+                         WHERE expires_date <= ?
+                         ORDER BY expires_date
+                         LIMIT ?""",
+                      (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), batch_size))
+            batch = c.fetchall()
+            if not batch:
+                return deleted
+
+            story_ids = [(story_id,) for story_id, _ in batch]
+            c.executemany("DELETE FROM story_views WHERE story_id = ?", story_ids)
+            c.executemany("DELETE FROM stories WHERE story_id = ?", story_ids)
+            _invalidate(c, 'stories', 'story_views')
+            files = []
+            for _, media_path in batch:
+                files.extend(_release_media(c, media_path))
+            if files:
+                _enqueue(c, 'remove_media', {'paths': files})
+        deleted += len(batch)
+        if len(batch) < batch_size:
+            return deleted
 
 def save_post(user_id, post_id):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    try:
-        c.execute("""INSERT INTO saved_posts 
-                     (user_id, post_id, created_date)
-                     VALUES (?, ?, ?)""",
-                  (user_id, post_id,
-                   datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close() 
+    with get_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("""INSERT INTO saved_posts 
+                         (user_id, post_id, created_date)
+                         VALUES (?, ?, ?)""",
+                      (user_id, post_id,
+                       datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            return True
+        except sqlite3.IntegrityError:
+            return False
 
 def create_challenge(creator_id, title, description, reward_points, duration_days):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    now = datetime.now()
-    ends = now + timedelta(days=duration_days)
+    with get_connection() as conn:
+        c = conn.cursor()
+        now = datetime.now()
+        ends = now + timedelta(days=duration_days)
     
-    c.execute("""INSERT INTO challenges 
-                 (creator_id, title, description, reward_points, 
-                  created_date, end_date, status)
-                 VALUES (?, ?, ?, ?, ?, ?, ?)""",
-              (creator_id, title, description, reward_points,
-               now.strftime("%Y-%m-%d %H:%M:%S"),
-               ends.strftime("%Y-%m-%d %H:%M:%S"),
-               'active'))
-    conn.commit()
-    conn.close()
+        c.execute("""INSERT INTO challenges 
+                     (creator_id, title, description, reward_points, 
+                      created_date, end_date, status)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                  (creator_id, title, description, reward_points,
+                   now.strftime("%Y-%m-%d %H:%M:%S"),
+                   ends.strftime("%Y-%m-%d %H:%M:%S"),
+                   'active'))
+        _invalidate(c, 'challenges')
+
+def get_active_challenges():
+    """Challenges still open, newest first, with their submission counts."""
+    # Cached per minute, like get_live_stories
+    return _get_active_challenges(datetime.now().strftime("%Y-%m-%d %H:%M:00"))
+
+@query_cache.cached('challenges', 'challenge_submissions', 'users')
+def _get_active_challenges(as_of):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("""SELECT c.*, u.username, COUNT(s.submission_id) as submissions
+                     FROM challenges c
+                     JOIN users u ON c.creator_id = u.user_id
+                     LEFT JOIN challenge_submissions s ON c.challenge_id = s.challenge_id
+                     WHERE c.end_date > ?
+                     GROUP BY c.challenge_id
+                     ORDER BY c.created_date DESC""",
+                  (as_of,))
+        return [dict(row) for row in c.fetchall()]
 
 def submit_challenge(challenge_id, user_id, media_path, caption):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
+    with get_connection() as conn:
+        c = conn.cursor()
     
-    c.execute("""INSERT INTO challenge_submissions 
-                 (challenge_id, user_id, media_path, caption, created_date)
-                 VALUES (?, ?, ?, ?, ?)""",
-              (challenge_id, user_id, media_path, caption,
-               datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close() 
+        c.execute("""INSERT INTO challenge_submissions 
+                     (challenge_id, user_id, media_path, caption, created_date)
+                     VALUES (?, ?, ?, ?, ?)""",
+                  (challenge_id, user_id, media_path, caption,
+                   datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        _retain_media(c, media_path)
+        _invalidate(c, 'challenge_submissions')
 
 def report_content(reporter_id, content_type, content_id, reason):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
+    with get_connection() as conn:
+        c = conn.cursor()
     
-    c.execute("""INSERT INTO reports 
-                 (reporter_id, content_type, content_id, reason, status, created_date)
-                 VALUES (?, ?, ?, ?, ?, ?)""",
-              (reporter_id, content_type, content_id, reason, 'pending',
-               datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close() 
+        c.execute("""INSERT INTO reports 
+                     (reporter_id, content_type, content_id, reason, status, created_date)
+                     VALUES (?, ?, ?, ?, ?, ?)""",
+                  (reporter_id, content_type, content_id, reason, 'pending',
+                   datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        _refresh_queue_item(c, content_type, content_id)
+
+def _report_priority(report_count, reporter_count, views, trend_level):
+    # Distinct reporters count most, so one user reporting repeatedly can't
+    # bury everything else; reach scales it so widely seen content comes first
+    return ((3 * reporter_count + report_count) * max(trend_level or 1, 1)
+            * (1 + math.log10(1 + max(views or 0, 0))))
+
+def _refresh_queue_item(c, content_type, content_id):
+    """Recompute one item's moderation_queue row from its pending reports."""
+    c.execute("""SELECT COUNT(*), COUNT(DISTINCT reporter_id),
+                        MIN(created_date), MAX(created_date)
+                 FROM reports
+                 WHERE content_type = ? AND content_id = ? AND status = 'pending'""",
+              (content_type, content_id))
+    report_count, reporter_count, first_reported, last_reported = c.fetchone()
+    if not report_count:
+        c.execute("DELETE FROM moderation_queue WHERE content_type = ? AND content_id = ?",
+                  (content_type, content_id))
+        return
+
+    views, trend_level = 0, 1
+    if content_type == 'post':
+        c.execute("SELECT views, trend_level FROM posts WHERE post_id = ?", (content_id,))
+        views, trend_level = c.fetchone() or (0, 1)
+    c.execute("""INSERT OR REPLACE INTO moderation_queue
+                 (content_type, content_id, report_count, reporter_count, reach,
+                  priority, first_reported, last_reported)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+              (content_type, content_id, report_count, reporter_count, views or 0,
+               _report_priority(report_count, reporter_count, views, trend_level),
+               first_reported, last_reported))
+
+def rebuild_moderation_queue():
+    """Recompute the whole moderation queue from the reports table."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM moderation_queue")
+        c.execute("""SELECT DISTINCT content_type, content_id FROM reports
+                     WHERE status = 'pending'""")
+        for content_type, content_id in c.fetchall():
+            _refresh_queue_item(c, content_type, content_id)
+
+def get_moderation_queue(cursor=None, limit=Config.ADMIN_PAGE_SIZE):
+    """One page of reported items, highest priority first.
+
+    Reads idx_moderation_queue_priority backwards from ``cursor``, the
+    ``(priority, content_type, content_id)`` of the last item shown.
+    Posts carry their author, caption and thumbnail; every item carries
+    its distinct report ``reasons``. Returns ``(items, next_cursor)``.
+    """
+    where = ""
+    params = []
+    if cursor:
+        where = "WHERE (q.priority, q.content_type, q.content_id) < (?, ?, ?)"
+        params.extend(cursor)
+
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute(f"""SELECT q.*, u.username, p.caption, p.media_type,
+                             thumb.path as thumbnail_path,
+                             (SELECT group_concat(reason, '; ')
+                              FROM (SELECT DISTINCT reason FROM reports r
+                                    WHERE r.content_type = q.content_type
+                                    AND r.content_id = q.content_id
+                                    AND r.status = 'pending')) as reasons
+                      FROM moderation_queue q
+                      LEFT JOIN posts p
+                          ON q.content_type = 'post' AND p.post_id = q.content_id
+                      LEFT JOIN users u ON u.user_id = p.user_id
+                      LEFT JOIN media_renditions thumb
+                          ON thumb.source_path = p.video_path
+                          AND thumb.variant IN ('story', 'poster')
+                      {where}
+                      ORDER BY q.priority DESC, q.content_type DESC, q.content_id DESC
+                      LIMIT ?""",
+                  (*params, limit + 1))
+        items = [dict(row) for row in c.fetchall()]
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = (last['priority'], last['content_type'], last['content_id'])
+    return items, next_cursor
+
+def resolve_reports(content_type, content_id, status='resolved', remove=False):
+    """Close every pending report on an item, in one transaction.
+
+    ``status`` is recorded on the reports ('resolved' or 'dismissed').
+    With ``remove``, a reported post is deleted in the same transaction.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""UPDATE reports SET status = ?
+                     WHERE content_type = ? AND content_id = ? AND status = 'pending'""",
+                  (status, content_type, content_id))
+        c.execute("DELETE FROM moderation_queue WHERE content_type = ? AND content_id = ?",
+                  (content_type, content_id))
+        if remove and content_type == 'post':
+            files = _delete_post(c, content_id)
+            # None when it was already deleted elsewhere; the reports still close
+            if files:
+                _enqueue(c, 'remove_media', {'paths': files})
 
 def mark_messages_as_read(user_id, sender_id):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""UPDATE messages 
-                 SET is_read = 1
-                 WHERE sender_id = ? AND receiver_id = ? AND is_read = 0""",
-              (sender_id, user_id))
-    conn.commit()
-    conn.close() 
\ No newline at end of file
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""UPDATE messages 
+                     SET is_read = 1
+                     WHERE sender_id = ? AND receiver_id = ? AND is_read = 0""",
+                  (sender_id, user_id))
+        column = 'unread_a' if user_id < sender_id else 'unread_b'
+        c.execute(f"""UPDATE conversations SET {column} = 0
+                      WHERE user_a = ? AND user_b = ?""",
+                  tuple(sorted((user_id, sender_id))))
+        _invalidate(c, 'messages', 'conversations')
+
+def _enqueue(c, kind, payload=None, priority=0, dedup_key=None, delay=0,
+             max_attempts=Config.JOB_MAX_ATTEMPTS):
+    now = datetime.now()
+    c.execute("""INSERT OR IGNORE INTO jobs
+                 (kind, payload, priority, dedup_key, max_attempts,
+                  available_at, created_date)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)""",
+              (kind, json.dumps(payload), priority, dedup_key, max_attempts,
+               (now + timedelta(seconds=delay)).strftime("%Y-%m-%d %H:%M:%S"),
+               now.strftime("%Y-%m-%d %H:%M:%S")))
+    return c.lastrowid if c.rowcount else None
+
+def enqueue(kind, payload=None, priority=0, dedup_key=None, delay=0,
+            max_attempts=Config.JOB_MAX_ATTEMPTS):
+    """Queue a background job for the workers in jobs.py.
+
+    Higher ``priority`` runs first. While a job with the same
+    ``dedup_key`` is queued or running, further ones are dropped. Returns
+    the new job_id, or None if it was deduplicated.
+    """
+    with get_connection() as conn:
+        return _enqueue(conn.cursor(), kind, payload, priority, dedup_key,
+                        delay, max_attempts)
+
+def claim_job():
+    """Atomically take the next runnable job, or return None.
+
+    The claim expires after JOB_VISIBILITY_TIMEOUT, so a job whose worker
+    died is picked up again by another one.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute("BEGIN IMMEDIATE")
+        now = datetime.now()
+        now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+        # Expired claims with no attempts left have failed for good
+        c.execute("""UPDATE jobs SET status = 'failed', last_error = 'Timed out'
+                     WHERE status = 'running' AND available_at <= ?
+                     AND attempts >= max_attempts""",
+                  (now_str,))
+        c.execute("""SELECT * FROM jobs
+                     WHERE status IN ('queued', 'running') AND available_at <= ?
+                     ORDER BY priority DESC, available_at
+                     LIMIT 1""",
+                  (now_str,))
+        job = c.fetchone()
+        if job is None:
+            return None
+
+        locked_until = now + timedelta(seconds=Config.JOB_VISIBILITY_TIMEOUT)
+        c.execute("""UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                     available_at = ?
+                     WHERE job_id = ?""",
+                  (locked_until.strftime("%Y-%m-%d %H:%M:%S"), job['job_id']))
+        job = dict(job)
+        job['payload'] = json.loads(job['payload'])
+        job['attempts'] += 1
+        return job
+
+def complete_job(job_id):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+def fail_job(job_id, error):
+    """Schedule a retry with exponential backoff, or give up after max_attempts."""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT attempts, max_attempts FROM jobs WHERE job_id = ?", (job_id,))
+        row = c.fetchone()
+        if row is None:
+            return
+        attempts, max_attempts = row
+        retry_at = datetime.now() + timedelta(
+            seconds=Config.JOB_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+        c.execute("""UPDATE jobs SET status = ?, available_at = ?, last_error = ?
+                     WHERE job_id = ?""",
+                  ('failed' if attempts >= max_attempts else 'queued',
+                   retry_at.strftime("%Y-%m-%d %H:%M:%S"), error, job_id))
+
+if __name__ == "__main__":
+    import sys
+
+    commands = {
+        'init': init_db,
+        'recount': recount_counters,
+        'check-trends': lambda: print(check_trend_counters() or "Trend counters OK"),
+        'expire-stories': lambda: print(f"Expired {expire_stories()} stories"),
+        'backfill-stats': lambda: print(f"Rolled up {backfill_daily_stats()} rows"),
+        'rebuild-moderation': rebuild_moderation_queue,
+    }
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print(f"Usage: python database.py [{'|'.join(commands)}]")
+        sys.exit(1)
+    init_db()
+    commands[sys.argv[1]]()
@@ -0,0 +1,131 @@
+"""Background job workers backed by the jobs table in the app database.
+
+Queue work with ``database.enqueue(kind, payload)``; any number of worker
+processes on the box claim and run it. Run standalone workers with::
+
+    python jobs.py [workers]
+"""
+import multiprocessing
+import threading
+import time
+import traceback
+import media_store
+from config import Config
+from database import (claim_job, complete_job, enqueue, expire_stories,
+                      fail_job, init_db, notify_followers,
+                      rebuild_moderation_queue, reclaim_media, recount_counters,
+                      refresh_daily_stats)
+from renditions import process_renditions
+
+HANDLERS = {}
+
+def handler(kind):
+    """Register a function as the handler for jobs of ``kind``.
+
+    The handler is called with the job's payload as keyword arguments.
+    Handlers may run more than once for the same job (after a crash or a
+    visibility timeout), so they should be idempotent.
+    """
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+handler('renditions')(process_renditions)
+handler('notify_followers')(notify_followers)
+handler('recount_counters')(recount_counters)
+handler('expire_stories')(expire_stories)
+handler('refresh_daily_stats')(refresh_daily_stats)
+handler('rebuild_moderation_queue')(rebuild_moderation_queue)
+
+@handler('remove_media')
+def remove_media(paths):
+    # Unlink only what is still unreferenced now, not when it was queued.
+    # A blob an upload has just reused may be referenced once that upload
+    # commits, so it is looked at again later instead
+    later = [path for path in paths if media_store.recently_stored(path)]
+    for path, renditions in reclaim_media([p for p in paths if p not in later]):
+        if not media_store.release(path):
+            later.append(path)
+            continue
+        for rendition in renditions:
+            media_store.remove(rendition)
+    if later:
+        enqueue('remove_media', {'paths': later}, delay=Config.MEDIA_REUSE_GRACE)
+
+def run_job(job):
+    try:
+        func = HANDLERS[job['kind']]
+        func(**(job['payload'] or {}))
+    except Exception as e:
+        print(f"Job {job['job_id']} ({job['kind']}) failed: {str(e)}")
+        finish, args = fail_job, (job['job_id'], traceback.format_exc())
+    else:
+        finish, args = complete_job, (job['job_id'],)
+    try:
+        finish(*args)
+    except Exception as e:
+        # The claim expires and the job runs again, which handlers allow for
+        print(f"Job {job['job_id']} ({job['kind']}) could not be recorded: {str(e)}")
+
+def work(stop=None):
+    """Claim and run jobs until ``stop`` is set, polling when the queue is empty."""
+    while stop is None or not stop.is_set():
+        try:
+            job = claim_job()
+        except Exception as e:
+            # Typically the database being locked; try again on the next poll
+            print(f"Job claim failed: {str(e)}")
+            job = None
+        if job is None:
+            if stop is None:
+                time.sleep(Config.JOB_POLL_INTERVAL)
+            else:
+                stop.wait(Config.JOB_POLL_INTERVAL)
+            continue
+        run_job(job)
+
+def _start_worker(context, stop, name):
+    process = context.Process(target=work, args=(stop,), daemon=True, name=name)
+    process.start()
+    return process
+
+def _supervise(context, processes, stop):
+    # Replace workers that died (killed, crashed) until told to stop
+    while not stop.wait(Config.JOB_SUPERVISE_INTERVAL):
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                print(f"{process.name} exited with code {process.exitcode}, restarting")
+                processes[i] = _start_worker(context, stop, process.name)
+
+def start_workers(count=Config.JOB_WORKERS):
+    """Start ``count`` worker processes. Returns ``(processes, stop_event)``.
+
+    A background thread restarts any worker that exits before ``stop`` is
+    set; ``processes`` is updated in place as it does.
+    """
+    # Spawn rather than fork: the parent may be a threaded Streamlit server
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    processes = [_start_worker(context, stop, f"job-worker-{i}")
+                 for i in range(count)]
+    if processes:
+        threading.Thread(target=_supervise, args=(context, processes, stop),
+                         name="job-supervisor", daemon=True).start()
+    return processes, stop
+
+def stop_workers(processes, stop, timeout=None):
+    stop.set()
+    for process in processes:
+        process.join(timeout)
+
+if __name__ == "__main__":
+    import sys
+    init_db()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else Config.JOB_WORKERS
+    processes, stop = start_workers(count)
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        stop_workers(processes, stop)
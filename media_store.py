@@ -0,0 +1,106 @@
+import hashlib
+import os
+import tempfile
+import time
+from config import Config
+
+# Spellings of the same type, so identical bytes get one blob
+EXTENSION_ALIASES = {'.jpeg': '.jpg'}
+
+def blob_path(digest, extension):
+    """Sharded location of a blob: <root>/ab/cd/abcd...<extension>."""
+    extension = extension.lower()
+    extension = EXTENSION_ALIASES.get(extension, extension)
+    return os.path.join(Config.UPLOAD_PATHS['media'], digest[:2], digest[2:4],
+                        f"{digest}{extension}")
+
+def store(fileobj, extension):
+    """Stream ``fileobj`` into the store and return the blob's path.
+
+    The content is hashed while it is copied to a temporary file, which
+    is then renamed to its content address. Identical uploads resolve to
+    the same path and are only kept once on disk; reusing a blob touches
+    it, so release() leaves it alone until the upload has committed.
+    """
+    root = Config.UPLOAD_PATHS['media']
+    os.makedirs(root, exist_ok=True)
+    hasher = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=root, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                chunk = fileobj.read(Config.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                tmp.write(chunk)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+
+        path = blob_path(hasher.hexdigest(), extension)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            _fsync_dir(os.path.dirname(path))
+        else:
+            os.remove(tmp_path)
+        return path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _fsync_dir(directory):
+    # Make the rename itself durable; not supported on every platform
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def recently_stored(path):
+    """Whether store() wrote or reused ``path`` within MEDIA_REUSE_GRACE."""
+    try:
+        return time.time() - os.path.getmtime(path) < Config.MEDIA_REUSE_GRACE
+    except FileNotFoundError:
+        return False
+
+def release(path):
+    """Remove an unreferenced blob unless store() has just reused it.
+
+    Returns False if the blob was kept. It is moved aside before its age
+    is checked, so a concurrent store() either touched it first and it
+    is put back, or finds it gone and writes the bytes again.
+    """
+    removing = f"{path}.removing"
+    try:
+        os.replace(path, removing)
+    except FileNotFoundError:
+        remove(path)
+        return True
+    if recently_stored(removing):
+        os.replace(removing, path)
+        return False
+    remove(removing)
+    return True
+
+def remove(path):
+    """Unlink a file whose last reference is gone, pruning empty shard dirs."""
+    if os.path.exists(path):
+        os.remove(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    for root in (Config.UPLOAD_PATHS['media'], Config.UPLOAD_PATHS['renditions']):
+        root = os.path.abspath(root)
+        while directory.startswith(root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
@@ -1,14 +1,20 @@
 import streamlit as st
-import sqlite3
-import pandas as pd
 from database import (
-    create_post, add_comment, get_db_path, send_message,
+    create_post, add_comment, send_message,
     mark_messages_as_read, add_trend, has_user_trended,
-    create_user, authenticate_user, check_username_exists,
-    create_story, create_challenge, submit_challenge
+    check_username_exists,
+    create_story, create_challenge, submit_challenge, get_feed_page,
+    search_posts, search_users, autocomplete_usernames,
+    get_conversations, get_messages, get_renditions, get_live_stories,
+    report_content, get_active_challenges, get_profile_summary, update_profile
 )
+from renditions import schedule_renditions
+from uploads import save_upload, UploadError
+from config import Config
 import os
-from datetime import datetime
+
+REPORT_REASONS = ["Spam", "Harassment", "Nudity or sexual content",
+                  "Violence", "Other"]
 
 def show_home_page():
     st.markdown("""
@@ -23,49 +29,48 @@ def show_home_page():
     st.title("Home")
     
     # Show active stories
-    conn = sqlite3.connect(get_db_path())
-    stories = pd.read_sql_query("""
-        SELECT s.*, u.username
-        FROM stories s
-        JOIN users u ON s.user_id = u.user_id
-        WHERE s.created_date >= datetime('now', '-24 hours')
-        ORDER BY s.created_date DESC
-    """, conn)
+    stories = get_live_stories()
     
-    if not stories.empty:
+    if stories:
         st.subheader("Stories")
         story_cols = st.columns(min(4, len(stories)))
-        for idx, (_, story) in enumerate(stories.iterrows()):
+        for idx, story in enumerate(stories):
             with story_cols[idx % 4]:
                 if os.path.exists(story['media_path']):
-                    st.image(story['media_path'], 
+                    st.image(story['story_path'] or story['media_path'], 
                             caption=story['username'],
                             width=100)
     
     st.divider()
     
-    # Get posts with comments
-    posts = pd.read_sql_query("""
-        SELECT p.*, u.username, u.is_private,
-               COUNT(DISTINCT t.user_id) as trend_count
-        FROM posts p
-        JOIN users u ON p.user_id = u.user_id
-        LEFT JOIN trends t ON p.post_id = t.post_id
-        WHERE u.is_private = 0 AND p.is_archived = 0
-        GROUP BY p.post_id
-        ORDER BY p.created_date DESC
-    """, conn)
+    # Posts arrive a page at a time with their latest comments attached;
+    # pages already loaded are kept in the session until the next refresh
+    if st.button("Refresh feed"):
+        reset_feed()
+    if 'feed_posts' not in st.session_state:
+        st.session_state.feed_posts, st.session_state.feed_cursor = get_feed_page()
     
-    for _, post in posts.iterrows():
+    for post in st.session_state.feed_posts:
         with st.container():
             col1, col2 = st.columns([3, 1])
             with col1:
                 # Display media
                 try:
                     if post['media_type'] == 'image':
-                        st.image(post['video_path'], width=300)
+                        st.image(post['feed_path'] or post['video_path'], width=300)
+                    elif (post['poster_path']
+                          and st.session_state.get('playing_post') != post['post_id']):
+                        # Only load the video itself once the viewer asks for it
+                        st.image(post['poster_path'], width=300)
+                        if post['duration']:
+                            minutes, seconds = divmod(int(post['duration']), 60)
+                            st.caption(f"{minutes}:{seconds:02d}")
+                        # Set before the click's rerun, so no st.rerun() is
+                        # needed here, where the except below would swallow it
+                        st.button("▶ Play", key=f"play_{post['post_id']}",
+                                  on_click=play_post, args=(post['post_id'],))
                     else:
-                        st.video(post['video_path'])
+                        st.video(post['feed_path'] or post['video_path'])
                 except Exception as e:
                     st.error("Media not available")
                 
@@ -78,20 +83,13 @@ def show_home_page():
                     if st.button("🔥", key=f"trend_{post['post_id']}"):
                         if not has_user_trended(post['post_id'], st.session_state.user_id):
                             add_trend(post['post_id'], st.session_state.user_id, True)
+                            reset_feed()
                             st.rerun()
                 with trend_col2:
                     st.write(f"{post['trend_count']} trends")
                 
                 # Comments
-                comments = pd.read_sql_query("""
-                    SELECT c.*, u.username
-                    FROM comments c
-                    JOIN users u ON c.user_id = u.user_id
-                    WHERE c.post_id = ?
-                    ORDER BY c.created_date DESC
-                """, conn, params=(post['post_id'],))
-                
-                for _, comment in comments.iterrows():
+                for comment in post['comments']:
                     st.text(f"{comment['username']}: {comment['comment']}")
                 
                 # Add comment
@@ -99,51 +97,64 @@ def show_home_page():
                 if st.button("Comment", key=f"send_{post['post_id']}"):
                     if new_comment.strip():
                         add_comment(post['post_id'], st.session_state.user_id, new_comment)
+                        reset_feed()
                         st.rerun()
+                
+                with st.expander("Report"):
+                    reason = st.selectbox("Reason", REPORT_REASONS,
+                                          key=f"report_reason_{post['post_id']}")
+                    if st.button("Send report", key=f"report_{post['post_id']}"):
+                        report_content(st.session_state.user_id, 'post',
+                                       post['post_id'], reason)
+                        st.success("Thanks, a moderator will review this post")
     
-    conn.close()
+    if st.session_state.feed_cursor is not None:
+        if st.button("Load more"):
+            posts, st.session_state.feed_cursor = get_feed_page(st.session_state.feed_cursor)
+            st.session_state.feed_posts += posts
+            st.rerun()
+
+def play_post(post_id):
+    st.session_state.playing_post = post_id
+
+def reset_feed():
+    st.session_state.pop('feed_posts', None)
+    st.session_state.pop('feed_cursor', None)
 
 def show_search_page():
     st.title("Search")
     
     search_term = st.text_input("Search users or posts...")
     
+    # Start from the first page whenever the search term changes
+    if st.session_state.get('search_term') != search_term:
+        st.session_state.search_term = search_term
+        st.session_state.search_page = 0
+    page = st.session_state.search_page
+    
     if search_term:
-        conn = sqlite3.connect(get_db_path())
-        
-        # Search users
-        users = pd.read_sql_query("""
-            SELECT user_id, username, profile_pic
-            FROM users 
-            WHERE username LIKE ? OR email LIKE ?
-        """, conn, params=(f"%{search_term}%", f"%{search_term}%"))
-        
-        # Search posts
-        posts = pd.read_sql_query("""
-            SELECT p.*, u.username
-            FROM posts p
-            JOIN users u ON p.user_id = u.user_id
-            WHERE caption LIKE ? OR username LIKE ?
-            AND u.is_private = 0
-        """, conn, params=(f"%{search_term}%", f"%{search_term}%"))
+        users = search_users(search_term, page)
+        posts = search_posts(search_term, page)
         
         # Show results
-        if not users.empty:
+        if users:
             st.subheader("Users")
-            for _, user in users.iterrows():
+            for user in users:
                 col1, col2 = st.columns([1, 4])
                 with col1:
                     st.markdown("👤")
                 with col2:
                     st.write(user['username'])
         
-        if not posts.empty:
+        if posts:
             st.subheader("Posts")
-            for _, post in posts.iterrows():
+            feed_paths = get_renditions([post['video_path'] for post in posts], 'feed')
+            for post in posts:
                 with st.container():
                     try:
                         if post['media_type'] == 'image':
-                            st.image(post['video_path'], width=300)
+                            st.image(feed_paths.get(post['video_path'], post['video_path']),
+                                     width=300)
                         else:
                             st.video(post['video_path'])
                     except:
@@ -151,30 +162,38 @@ def show_search_page():
                     st.write(f"Posted by: {post['username']}")
                     st.write(post['caption'])
         
-        conn.close()
+        prev_col, next_col = st.columns(2)
+        with prev_col:
+            if page > 0 and st.button("Previous"):
+                st.session_state.search_page -= 1
+                st.rerun()
+        with next_col:
+            if (len(users) == Config.SEARCH_PAGE_SIZE
+                    or len(posts) == Config.SEARCH_PAGE_SIZE) and st.button("Next"):
+                st.session_state.search_page += 1
+                st.rerun()
 
 def show_add_post():
     st.title("Add Post")
     
     media_type = st.radio("Select media type:", ["Image", "Video"])
-    uploaded_file = st.file_uploader(
-        f"Upload {media_type}", 
-        type=['png', 'jpg', 'jpeg'] if media_type == "Image" else ['mp4', 'mov']
-    )
+    allowed_types = ['png', 'jpg', 'jpeg'] if media_type == "Image" else ['mp4', 'mov']
+    uploaded_file = st.file_uploader(f"Upload {media_type}", type=allowed_types)
     
     if uploaded_file:
         caption = st.text_area("Caption")
         if st.button("Post"):
             # Save file
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            file_extension = os.path.splitext(uploaded_file.name)[1]
-            filename = f"{st.session_state.username}_{timestamp}{file_extension}"
-            file_path = os.path.join("uploads", "posts", filename)
-            
-            with open(file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
+            try:
+                file_path = save_upload(uploaded_file, allowed_types)
+            except UploadError as e:
+                st.error(str(e))
+                return
             
-            create_post(st.session_state.user_id, file_path, caption, media_type.lower())
+            create_post(st.session_state.user_id, file_path, caption)
+            schedule_renditions(file_path)
+            # Reload the feed from the top so the new post shows up
+            reset_feed()
             st.success("Post created!")
             st.rerun()
 
@@ -183,22 +202,19 @@ def show_stories_page():
     
     # Add create story button
     if st.button("Create New Story"):
-        uploaded_file = st.file_uploader("Upload Story", type=['png', 'jpg', 'jpeg', 'mp4'])
+        allowed_types = ['png', 'jpg', 'jpeg', 'mp4']
+        uploaded_file = st.file_uploader("Upload Story", type=allowed_types)
         if uploaded_file:
             caption = st.text_input("Caption (optional)")
             if st.button("Share Story"):
-                # Create directory if not exists
-                os.makedirs("uploads/stories", exist_ok=True)
-                
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                file_extension = os.path.splitext(uploaded_file.name)[1]
-                filename = f"{st.session_state.username}_{timestamp}{file_extension}"
-                file_path = os.path.join("uploads", "stories", filename)
-                
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
+                try:
+                    file_path = save_upload(uploaded_file, allowed_types)
+                except UploadError as e:
+                    st.error(str(e))
+                    return
                 
                 create_story(st.session_state.user_id, file_path, caption)
+                schedule_renditions(file_path)
                 st.success("Story shared!")
                 st.rerun()
 
@@ -208,38 +224,20 @@ def show_messages_page():
     # Add a search bar to start new conversations
     new_message = st.text_input("Search user to message...")
     if new_message:
-        conn = sqlite3.connect(get_db_path())
-        users = pd.read_sql_query("""
-            SELECT user_id, username FROM users 
-            WHERE username LIKE ? AND user_id != ?
-        """, conn, params=(f"%{new_message}%", st.session_state.user_id))
+        users = autocomplete_usernames(new_message, st.session_state.user_id)
         
-        for _, user in users.iterrows():
+        for user in users:
             if st.button(f"Message {user['username']}", key=f"new_msg_{user['user_id']}"):
                 st.session_state.active_chat = user['user_id']
                 st.session_state.chat_username = user['username']
                 st.rerun()
-        conn.close()
 
     # Show existing conversations in sidebar
     with st.sidebar:
         st.subheader("Recent Chats")
-        conn = sqlite3.connect(get_db_path())
-        conversations = pd.read_sql_query("""
-            SELECT DISTINCT 
-                CASE WHEN m.sender_id = ? THEN m.receiver_id ELSE m.sender_id END as other_user_id,
-                u.username,
-                COUNT(CASE WHEN m.is_read = 0 AND m.receiver_id = ? THEN 1 END) as unread_count,
-                MAX(m.created_date) as last_message
-            FROM messages m
-            JOIN users u ON u.user_id = 
-                CASE WHEN m.sender_id = ? THEN m.receiver_id ELSE m.sender_id END
-            WHERE m.sender_id = ? OR m.receiver_id = ?
-            GROUP BY other_user_id
-            ORDER BY last_message DESC
-        """, conn, params=(st.session_state.user_id,)*5)
+        conversations = get_conversations(st.session_state.user_id)
 
-        for _, conv in conversations.iterrows():
+        for conv in conversations:
             if st.button(
                 f"{conv['username']} {'🔵' if conv['unread_count'] > 0 else ''}", 
                 key=f"chat_{conv['other_user_id']}"
@@ -253,21 +251,31 @@ def show_messages_page():
     if 'active_chat' in st.session_state and st.session_state.active_chat:
         st.subheader(f"Chat with {st.session_state.chat_username}")
         
-        # Message history
-        messages = pd.read_sql_query("""
-            SELECT m.*, u.username 
-            FROM messages m
-            JOIN users u ON m.sender_id = u.user_id
-            WHERE (sender_id = ? AND receiver_id = ?)
-            OR (sender_id = ? AND receiver_id = ?)
-            ORDER BY m.created_date
-        """, conn, params=(st.session_state.user_id, st.session_state.active_chat,
-                         st.session_state.active_chat, st.session_state.user_id))
+        # Message history: load the latest window when a chat is opened,
+        # then only fetch messages newer than the last one already shown
+        conversation = (st.session_state.user_id, st.session_state.active_chat)
+        if st.session_state.get('chat_conversation') != conversation:
+            st.session_state.chat_conversation = conversation
+            st.session_state.chat_messages = get_messages(conversation)
+            st.session_state.chat_has_older = (
+                len(st.session_state.chat_messages) == Config.CHAT_PAGE_SIZE)
+        elif st.session_state.chat_messages:
+            st.session_state.chat_messages += get_messages(
+                conversation, after_id=st.session_state.chat_messages[-1]['message_id'])
+        else:
+            st.session_state.chat_messages = get_messages(conversation)
+        messages = st.session_state.chat_messages
+        
+        if st.session_state.chat_has_older and st.button("Load older messages"):
+            older = get_messages(conversation, before_id=messages[0]['message_id'])
+            st.session_state.chat_messages = older + messages
+            st.session_state.chat_has_older = len(older) == Config.CHAT_PAGE_SIZE
+            st.rerun()
         
         # Show messages in a container
         chat_container = st.container()
         with chat_container:
-            for _, msg in messages.iterrows():
+            for msg in messages:
                 is_me = msg['sender_id'] == st.session_state.user_id
                 st.markdown(
                     f"""<div style='text-align: {'right' if is_me else 'left'}'>
@@ -294,8 +302,6 @@ def show_messages_page():
                     send_message(st.session_state.user_id, st.session_state.active_chat, message)
                     st.rerun()
 
-    conn.close()
-
 def show_challenges_page():
     st.title("Challenges")
     
@@ -318,18 +324,7 @@ def show_challenges_page():
             st.rerun()
     
     # Show active challenges
-    conn = sqlite3.connect(get_db_path())
-    challenges = pd.read_sql_query("""
-        SELECT c.*, u.username, COUNT(s.submission_id) as submissions
-        FROM challenges c
-        JOIN users u ON c.creator_id = u.user_id
-        LEFT JOIN challenge_submissions s ON c.challenge_id = s.challenge_id
-        WHERE c.end_date > datetime('now')
-        GROUP BY c.challenge_id
-        ORDER BY c.created_date DESC
-    """, conn)
-    
-    for _, challenge in challenges.iterrows():
+    for challenge in get_active_challenges():
         with st.container():
             st.subheader(challenge['title'])
             st.write(f"By: {challenge['username']}")
@@ -338,66 +333,44 @@ def show_challenges_page():
             st.write(f"Submissions: {challenge['submissions']}")
             
             if st.button("Submit Entry", key=f"submit_{challenge['challenge_id']}"):
+                allowed_types = ['png', 'jpg', 'jpeg', 'mp4']
                 uploaded_file = st.file_uploader("Upload your submission", 
-                                              type=['png', 'jpg', 'jpeg', 'mp4'])
+                                              type=allowed_types)
                 if uploaded_file:
                     caption = st.text_input("Add caption")
                     if st.button("Submit"):
                         # Save submission
-                        os.makedirs("uploads/challenges", exist_ok=True)
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        file_extension = os.path.splitext(uploaded_file.name)[1]
-                        filename = f"challenge_{challenge['challenge_id']}_{timestamp}{file_extension}"
-                        file_path = os.path.join("uploads", "challenges", filename)
-                        
-                        with open(file_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
+                        try:
+                            file_path = save_upload(uploaded_file, allowed_types)
+                        except UploadError as e:
+                            st.error(str(e))
+                            return
                         
                         submit_challenge(challenge['challenge_id'], 
                                       st.session_state.user_id,
                                       file_path, caption)
+                        schedule_renditions(file_path)
                         st.success("Entry submitted!")
                         st.rerun()
-    
-    conn.close()
 
 def show_profile_page():
     st.title("Profile")
     
-    conn = sqlite3.connect(get_db_path())
-    user = pd.read_sql_query("""
-        SELECT u.*, 
-               COUNT(DISTINCT f1.follower_id) as followers,
-               COUNT(DISTINCT f2.user_id) as following,
-               COUNT(DISTINCT p.post_id) as posts
-        FROM users u
-        LEFT JOIN followers f1 ON u.user_id = f1.user_id
-        LEFT JOIN followers f2 ON u.user_id = f2.follower_id
-        LEFT JOIN posts p ON u.user_id = p.user_id
-        WHERE u.user_id = ?
-        GROUP BY u.user_id
-    """, conn, params=(st.session_state.user_id,)).iloc[0]
+    user = get_profile_summary(st.session_state.user_id)
     
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.metric("Posts", user['posts'])
+        st.metric("Posts", user['post_count'])
     with col2:
-        st.metric("Followers", user['followers'])
+        st.metric("Followers", user['follower_count'])
     with col3:
-        st.metric("Following", user['following'])
+        st.metric("Following", user['following_count'])
     
     # Add settings
     if st.button("Settings"):
         is_private = st.checkbox("Private Account", value=user['is_private'])
         bio = st.text_area("Bio", value=user['bio'] if user['bio'] else "")
         if st.button("Save Changes"):
-            c = conn.cursor()
-            c.execute("""UPDATE users 
-                        SET is_private = ?, bio = ?
-                        WHERE user_id = ?""",
-                     (is_private, bio, st.session_state.user_id))
-            conn.commit()
+            update_profile(st.session_state.user_id, is_private, bio)
             st.success("Profile updated!")
-            st.rerun()
-    
-    conn.close() 
\ No newline at end of file
+            st.rerun()
\ No newline at end of file
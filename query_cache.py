@@ -0,0 +1,107 @@
+"""In-process cache for read queries, invalidated by table version counters.
+
+Read functions declare the tables they depend on with ``@cached(...)``.
+Writers bump those tables' counters in the database (see
+database._invalidate), so writes from any process are seen. A cached
+result is only served while none of its tables has changed since it was
+computed.
+"""
+import functools
+import pickle
+import threading
+from collections import OrderedDict
+from config import Config
+
+_lock = threading.Lock()
+_versions = {}
+_entries = OrderedDict()  # key -> (table versions, pickled result)
+_size = 0
+_version_source = None
+_source_token = None
+
+def set_version_source(source):
+    """Install ``source(token) -> (token, versions)`` for reading table versions.
+
+    ``source`` is called before every cached read with the token it last
+    returned. It should be cheap when nothing has changed, returning
+    ``versions`` as None in that case.
+    """
+    global _version_source, _source_token
+    with _lock:
+        _version_source = source
+        _source_token = None
+
+def versions(tables):
+    global _versions, _source_token
+    with _lock:
+        if _version_source is not None:
+            _source_token, changed = _version_source(_source_token)
+            if changed is not None:
+                _versions = changed
+        return tuple(_versions.get(table, 0) for table in tables)
+
+def _evict(max_bytes):
+    global _size
+    while _size > max_bytes and _entries:
+        _, (_, blob) = _entries.popitem(last=False)
+        _size -= len(blob)
+
+def _store(key, stamp, blob):
+    global _size
+    with _lock:
+        old = _entries.pop(key, None)
+        if old:
+            _size -= len(old[1])
+        if len(blob) > Config.QUERY_CACHE_MAX_BYTES:
+            return
+        _entries[key] = (stamp, blob)
+        _size += len(blob)
+        _evict(Config.QUERY_CACHE_MAX_BYTES)
+
+def _lookup(key, stamp):
+    global _size
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != stamp:
+            del _entries[key]
+            _size -= len(entry[1])
+            return None
+        _entries.move_to_end(key)
+        return entry[1]
+
+def cached(*tables):
+    """Cache a read function's results until one of ``tables`` is written.
+
+    Results are stored pickled: that bounds memory by real size and hands
+    every caller its own copy, so callers may mutate what they get back.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not Config.QUERY_CACHE_MAX_BYTES:
+                return func(*args, **kwargs)
+            key = (func.__qualname__, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                # Unhashable arguments (lists) can't be cached
+                return func(*args, **kwargs)
+            # Versions are read before the query, so a write that commits
+            # meanwhile leaves this result already outdated, never stale
+            stamp = versions(tables)
+            blob = _lookup(key, stamp)
+            if blob is not None:
+                return pickle.loads(blob)
+            result = func(*args, **kwargs)
+            _store(key, stamp, pickle.dumps(result))
+            return result
+        return wrapper
+    return decorate
+
+def clear():
+    global _size
+    with _lock:
+        _entries.clear()
+        _size = 0
@@ -0,0 +1,135 @@
+import os
+import cv2
+from PIL import Image, ImageOps
+from config import Config
+from database import enqueue, record_renditions, record_video_metadata
+
+def rendition_path(source_path, variant, extension=None):
+    # Keep the source's extension in the name: the same bytes can be stored
+    # under two extensions, and each blob's renditions are reclaimed with it
+    name = os.path.basename(source_path).replace('.', '_')
+    if extension is None:
+        extension = 'webp' if Config.RENDITION_FORMAT == 'WEBP' else 'jpg'
+    # Sharded like the media store so no single directory grows unbounded
+    return os.path.join(Config.UPLOAD_PATHS['renditions'], name[:2], name[2:4],
+                        f"{name}_{variant}.{extension}")
+
+def make_renditions(source_path):
+    """Write a resized copy of an image for every size in RENDITION_SIZES.
+
+    Runs in a job worker. Returns ``(variant, path, width, height)``
+    for each rendition written.
+    """
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        has_alpha = 'A' in image.getbands()
+        if Config.RENDITION_FORMAT == 'JPEG' or not has_alpha:
+            image = image.convert('RGB')
+        else:
+            image = image.convert('RGBA')
+
+        renditions = []
+        for variant, size in Config.RENDITION_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail(size, Image.LANCZOS)
+            path = rendition_path(source_path, variant)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            resized.save(path, Config.RENDITION_FORMAT,
+                         quality=Config.RENDITION_QUALITY, optimize=True)
+            renditions.append((variant, path, resized.width, resized.height))
+        return renditions
+
+def _open_video_writer(path, fps, size):
+    # Only H.264 plays in browsers' <video>. The standard opencv-python
+    # wheels can't encode it, and an MPEG-4 Part 2 copy would be worse
+    # than the original, so return None and let the feed keep that
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'avc1'), fps, size)
+    if writer.isOpened():
+        return writer
+    writer.release()
+    if os.path.exists(path):
+        os.remove(path)
+    return None
+
+def make_video_renditions(source_path):
+    """Extract a poster frame and duration and write a size-capped copy.
+
+    Runs in a job worker. Returns ``(renditions, duration)`` where
+    renditions are ``(variant, path, width, height)`` tuples: a 'poster'
+    image and, when OpenCV can encode H.264, a 'feed' video scaled to fit
+    VIDEO_MAX_DIMENSION. The feed copy is re-encoded frame by frame and
+    carries no audio track.
+    """
+    capture = cv2.VideoCapture(source_path)
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video {source_path}")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        duration = frame_count / fps if frame_count > 0 else None
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        # Poster: a frame one second in (or midway through short clips),
+        # so it is less likely to be a black fade-in
+        capture.set(cv2.CAP_PROP_POS_FRAMES, min(int(fps), frame_count // 2))
+        ok, frame = capture.read()
+        if not ok:
+            raise ValueError(f"Cannot read frames from {source_path}")
+        poster = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        poster.thumbnail(Config.RENDITION_SIZES['feed'], Image.LANCZOS)
+        poster_path = rendition_path(source_path, 'poster')
+        os.makedirs(os.path.dirname(poster_path), exist_ok=True)
+        poster.save(poster_path, Config.RENDITION_FORMAT,
+                    quality=Config.RENDITION_QUALITY, optimize=True)
+        renditions = [('poster', poster_path, poster.width, poster.height)]
+
+        # Size-capped copy; dimensions must stay even for most encoders
+        scale = min(1.0, Config.VIDEO_MAX_DIMENSION / max(width, height))
+        size = (int(width * scale) // 2 * 2, int(height * scale) // 2 * 2)
+        video_path = rendition_path(source_path, 'feed', 'mp4')
+        writer = _open_video_writer(video_path, fps, size)
+        if writer is None:
+            return renditions, duration
+        try:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                writer.write(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+        finally:
+            writer.release()
+        renditions.append(('feed', video_path, size[0], size[1]))
+        return renditions, duration
+    finally:
+        capture.release()
+
+def is_image(path):
+    return path.lower().endswith(tuple(f".{ext}" for ext in Config.ALLOWED_IMAGE_TYPES))
+
+def is_video(path):
+    return path.lower().endswith(tuple(f".{ext}" for ext in Config.ALLOWED_VIDEO_TYPES))
+
+def process_renditions(source_path):
+    """Generate and record renditions for an upload; the 'renditions' job."""
+    if is_image(source_path):
+        record_renditions(source_path, make_renditions(source_path))
+    elif is_video(source_path):
+        renditions, duration = make_video_renditions(source_path)
+        record_renditions(source_path, renditions)
+        record_video_metadata(source_path, duration)
+
+def schedule_renditions(source_path):
+    """Queue rendition generation for an uploaded image or video.
+
+    Returns the job_id immediately. Until a worker has recorded the
+    renditions, pages fall back to the original. Uploads are
+    content-addressed, so re-uploads of the same file share one job.
+    """
+    if not (is_image(source_path) or is_video(source_path)):
+        return None
+    # Images first: they are quick and block the feed more visibly
+    return enqueue('renditions', {'source_path': source_path},
+                   priority=1 if is_image(source_path) else 0,
+                   dedup_key=f"renditions:{source_path}")
@@ -0,0 +1,61 @@
+import os
+import media_store
+from config import Config
+
+class UploadError(ValueError):
+    pass
+
+# Leading bytes each allowed file type must start with, as (offset, signature)
+MAGIC_NUMBERS = {
+    'png': [(0, b'\x89PNG\r\n\x1a\n')],
+    'jpg': [(0, b'\xff\xd8\xff')],
+    'jpeg': [(0, b'\xff\xd8\xff')],
+    'gif': [(0, b'GIF87a'), (0, b'GIF89a')],
+    'mp4': [(4, b'ftyp')],
+    'mov': [(4, b'ftyp'), (4, b'moov'), (4, b'mdat'), (4, b'wide'), (4, b'free')],
+    'avi': [(0, b'RIFF')],
+}
+
+class _CheckedReader:
+    """Wraps an upload so limits are enforced chunk by chunk as it is copied."""
+
+    def __init__(self, fileobj, extension, max_size):
+        self.fileobj = fileobj
+        self.extension = extension
+        self.max_size = max_size
+        self.total = 0
+
+    def read(self, size):
+        chunk = self.fileobj.read(size)
+        if self.total == 0 and not _matches_magic(self.extension, chunk):
+            raise UploadError(f"File content does not look like a .{self.extension} file")
+        self.total += len(chunk)
+        if self.total > self.max_size:
+            raise UploadError(f"File is larger than {self.max_size // (1024 * 1024)}MB")
+        return chunk
+
+def _matches_magic(extension, head):
+    return any(head[offset:offset + len(signature)] == signature
+               for offset, signature in MAGIC_NUMBERS.get(extension, []))
+
+def save_upload(uploaded_file, allowed_types=None):
+    """Validate an uploaded file and save it to the media store.
+
+    The file is copied in UPLOAD_CHUNK_SIZE chunks, so memory use stays
+    constant. Wrong extensions are rejected before anything is written,
+    and wrong content or an oversize file as soon as it is read. Returns
+    the stored path; raises UploadError if the file is rejected.
+    """
+    if allowed_types is None:
+        allowed_types = Config.ALLOWED_IMAGE_TYPES + Config.ALLOWED_VIDEO_TYPES
+    extension = os.path.splitext(uploaded_file.name)[1].lower().lstrip('.')
+    if extension not in allowed_types:
+        raise UploadError(f"Unsupported file type: .{extension}")
+
+    # Browsers report the size up front; reject without reading when we can
+    size = getattr(uploaded_file, 'size', None)
+    if size is not None and size > Config.MAX_UPLOAD_SIZE:
+        raise UploadError(f"File is larger than {Config.MAX_UPLOAD_SIZE // (1024 * 1024)}MB")
+
+    reader = _CheckedReader(uploaded_file, extension, Config.MAX_UPLOAD_SIZE)
+    return media_store.store(reader, f".{extension}")
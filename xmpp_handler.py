@@ -1,70 +1,243 @@
 import slixmpp
 import asyncio
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
 from config import Config
+import database
+
+class MessageIngest:
+    """Persists inbound messages in batches without blocking the event loop.
+
+    Handlers await put(), which applies backpressure once the queue is
+    full. A writer task drains it and hands each batch of up to
+    XMPP_INGEST_BATCH_SIZE messages, or whatever arrived within
+    XMPP_INGEST_FLUSH_INTERVAL, to database.send_messages on a worker
+    thread, so a burst costs one commit instead of one per stanza.
+    """
+
+    def __init__(self, maxsize=Config.XMPP_INGEST_QUEUE_SIZE,
+                 batch_size=Config.XMPP_INGEST_BATCH_SIZE,
+                 flush_interval=Config.XMPP_INGEST_FLUSH_INTERVAL):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.closed = False
+        self._writer = asyncio.ensure_future(self._run())
+
+    async def put(self, sender, receiver, content):
+        if self.closed:
+            raise RuntimeError("Message ingest is closed")
+        created_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        await self.queue.put((sender, receiver, content, created_date))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        # Retry with backoff (e.g. 'database is locked' past the busy
+        # timeout); the queue backs up meanwhile, throttling senders
+        loop = asyncio.get_running_loop()
+        try:
+            for attempt in range(1, Config.XMPP_INGEST_MAX_ATTEMPTS + 1):
+                try:
+                    await loop.run_in_executor(None, self._store, batch)
+                    return
+                except Exception as e:
+                    print(f"Message ingest error (attempt {attempt}): {str(e)}")
+                    if attempt < Config.XMPP_INGEST_MAX_ATTEMPTS:
+                        await asyncio.sleep(min(2 ** attempt, Config.XMPP_INGEST_MAX_BACKOFF))
+            for sender, receiver, content, created_date in batch:
+                print(f"Message ingest gave up on message from {sender} to {receiver} "
+                      f"at {created_date}: {content!r}")
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    @staticmethod
+    def _store(batch):
+        # Stanzas carry usernames, lowercased by slixmpp; the messages
+        # table stores user ids
+        user_ids = database.get_user_ids(
+            name for sender, receiver, _, _ in batch for name in (sender, receiver))
+        messages = []
+        for sender, receiver, content, created_date in batch:
+            sender_id = user_ids.get(sender.lower())
+            receiver_id = user_ids.get(receiver.lower())
+            if sender_id is None or receiver_id is None:
+                print(f"Message ingest dropped message from {sender} to {receiver}: "
+                      f"unknown or ambiguous username")
+                continue
+            messages.append((sender_id, receiver_id, content, None, created_date))
+        database.send_messages(messages)
+
+    async def close(self):
+        """Stop accepting messages and wait until everything queued is stored."""
+        self.closed = True
+        await self.queue.join()
+        self._writer.cancel()
 
 class MessageClient(slixmpp.ClientXMPP):
-    def __init__(self, jid, password):
+    def __init__(self, jid, password, ingest, on_activity=None):
         super().__init__(jid, password)
+        self.ingest = ingest
+        self.on_activity = on_activity
+        self.reconnect_enabled = True
+        self.reconnect_attempts = 0
         self.add_event_handler('session_start', self.start)
         self.add_event_handler('message', self.message)
+        self.add_event_handler('disconnected', self.on_disconnected)
         
     async def start(self, event):
+        self.reconnect_attempts = 0
         self.send_presence()
         await self.get_roster()
         
     async def message(self, msg):
         if msg['type'] in ('chat', 'normal'):
-            from database import send_message
-            send_message(
-                sender_id=self.boundjid.bare,
-                receiver_id=msg['to'].bare,
+            if self.on_activity is not None:
+                self.on_activity()
+            await self.ingest.put(
+                sender=msg['from'].user,
+                receiver=self.boundjid.user,
                 content=msg['body']
             )
 
+    async def on_disconnected(self, event):
+        # Reconnect with exponential backoff unless we were shut down
+        if not self.reconnect_enabled:
+            return
+        delay = min(2 ** self.reconnect_attempts, Config.XMPP_RECONNECT_MAX_DELAY)
+        self.reconnect_attempts += 1
+        await asyncio.sleep(delay)
+        if self.reconnect_enabled:
+            self.connect()
+
+    def close(self):
+        self.reconnect_enabled = False
+        self.disconnect()
+
 class XMPPManager:
-    def __init__(self):
-        self.clients = {}
+    """Hosts every user's MessageClient on one event loop thread.
+
+    Callers on any thread submit work with run_coroutine_threadsafe. The
+    registry is bounded: the least recently used client is dropped when
+    it is full, and clients idle for longer than XMPP_IDLE_TIMEOUT are
+    disconnected by a background sweep. A client counts as used when it
+    is connected, sends, or receives a chat message, so users who only
+    receive stay online.
+    """
+
+    def __init__(self, max_clients=Config.XMPP_MAX_CLIENTS,
+                 idle_timeout=Config.XMPP_IDLE_TIMEOUT):
+        self.clients = OrderedDict()  # user_id -> MessageClient, LRU first
+        self.last_used = {}
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
         self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop,
+                                        name="xmpp-loop", daemon=True)
+        self._thread.start()
+        self.ingest = self._submit(self._start_ingest()).result()
+        self._sweeper = self._submit(self._evict_idle())
+
+    async def _start_ingest(self):
+        return MessageIngest()
+
+    def _run_loop(self):
         asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _touch(self, user_id):
+        # Only ever called on the loop thread. A message can still arrive
+        # on a client that has just been dropped
+        if user_id not in self.clients:
+            return
+        self.clients.move_to_end(user_id)
+        self.last_used[user_id] = time.monotonic()
+
+    def _drop(self, user_id):
+        client = self.clients.pop(user_id, None)
+        self.last_used.pop(user_id, None)
+        if client is not None:
+            client.close()
+
+    async def _connect(self, user_id, username):
+        if user_id in self.clients:
+            self._touch(user_id)
+            return
+        while len(self.clients) >= self.max_clients:
+            self._drop(next(iter(self.clients)))
+
+        # Created on the loop thread so slixmpp binds to this loop
+        jid = f"{username}@{Config.XMPP_SERVER}"
+        client = MessageClient(jid, Config.SECRET_KEY, self.ingest,
+                               on_activity=lambda: self._touch(user_id))
+        client.connect()
+        self.clients[user_id] = client
+        self._touch(user_id)
+
+    async def _send(self, sender_id, receiver_jid, content):
+        client = self.clients.get(sender_id)
+        if client is None:
+            return False
+        client.send_message(mto=receiver_jid, mbody=content, mtype='chat')
+        self._touch(sender_id)
+        return True
+
+    async def _evict_idle(self):
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            cutoff = time.monotonic() - self.idle_timeout
+            for user_id in [uid for uid, used in self.last_used.items() if used < cutoff]:
+                self._drop(user_id)
         
     def connect_user(self, user_id, username):
         try:
-            jid = f"{username}@{Config.XMPP_SERVER}"
-            password = Config.SECRET_KEY
-            
-            client = MessageClient(jid, password)
-            client.connect()
-            
-            def start_client():
-                self.loop.run_until_complete(client.process())
-            
-            import threading
-            thread = threading.Thread(target=start_client)
-            thread.daemon = True
-            thread.start()
-            
-            self.clients[user_id] = client
+            self._submit(self._connect(user_id, username)).result(
+                timeout=Config.XMPP_CALL_TIMEOUT)
             return True
         except Exception as e:
             print(f"XMPP connection error: {str(e)}")
             return False
+
+    def disconnect_user(self, user_id):
+        async def drop():
+            self._drop(user_id)
+        self._submit(drop()).result(timeout=Config.XMPP_CALL_TIMEOUT)
             
     def send_message(self, sender_id, receiver_id, content):
         try:
-            if sender_id in self.clients:
-                client = self.clients[sender_id]
-                receiver_jid = f"{receiver_id}@{Config.XMPP_SERVER}"
-                
-                async def send():
-                    client.send_message(
-                        mto=receiver_jid,
-                        mbody=content,
-                        mtype='chat'
-                    )
-                
-                self.loop.run_until_complete(send())
-                return True
-            return False
+            receiver_jid = f"{receiver_id}@{Config.XMPP_SERVER}"
+            return self._submit(self._send(sender_id, receiver_jid, content)).result(
+                timeout=Config.XMPP_CALL_TIMEOUT)
         except Exception as e:
             print(f"Send message error: {str(e)}")
-            return False 
\ No newline at end of file
+            return False
+
+    def shutdown(self):
+        async def close_all():
+            self._sweeper.cancel()
+            for user_id in list(self.clients):
+                self._drop(user_id)
+            # Everything already received must reach the database
+            await self.ingest.close()
+        self._submit(close_all()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=Config.XMPP_CALL_TIMEOUT)